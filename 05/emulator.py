@@ -0,0 +1,400 @@
+#!/usr/bin/env python
+import argparse
+import sys
+import time
+from array import array
+
+class LoadError(Exception):
+  pass
+
+ROM_SIZE = 32768
+RAM_SIZE = 32768
+# Memory maps, as in the assembler's SymbolTable.
+SCREEN = 0x4000
+KBD = 0x6000
+SCREEN_WIDTH = 512
+SCREEN_HEIGHT = 256
+
+_WORD_MASK = 0xffff
+_ADDRESS_MASK = 0x7fff
+
+'''Return the expression the ALU computes for the six control bits of a C-instruction (zx, nx, zy,
+ny, f and no, from most significant), as Python source in terms of d and y (the A register or M),
+which are unsigned 16-bit values, as is the result.'''
+def _alu_expression(control):
+  zx, nx, zy, ny, f, no = [(control >> bit) & 1 for bit in range(5, -1, -1)]
+  x = '0' if zx else 'd'
+  if nx:
+    x = '(%s ^ 65535)' % x
+  y = '0' if zy else 'y'
+  if ny:
+    y = '(%s ^ 65535)' % y
+  out = '(%s + %s)' % (x, y) if f else '(%s & %s)' % (x, y)
+  if no:
+    out = '(%s ^ 65535)' % out
+  return '%s & 65535' % out
+
+'''The expression computed for every combination of control bits, as from _alu_expression, with the
+combinations the assembler can write simplified.'''
+_COMP_EXPRESSIONS = dict([(control, _alu_expression(control)) for control in range(64)])
+_COMP_EXPRESSIONS.update({
+  0b101010: '0',
+  0b111111: '1',
+  0b111010: '65535',
+  0b001100: 'd',
+  0b110000: 'y',
+  0b001101: 'd ^ 65535',
+  0b110001: 'y ^ 65535',
+  0b001111: '-d & 65535',
+  0b110011: '-y & 65535',
+  0b011111: '(d + 1) & 65535',
+  0b110111: '(y + 1) & 65535',
+  0b001110: '(d - 1) & 65535',
+  0b110010: '(y - 1) & 65535',
+  0b000010: '(d + y) & 65535',
+  0b010011: '(d - y) & 65535',
+  0b000111: '(y - d) & 65535',
+  0b000000: 'd & y',
+  0b010101: 'd | y',
+})
+
+'''The condition on the ALU's output (unsigned) under which each jump field jumps.'''
+_JUMP_CONDITIONS = {
+  0b001: '0 < out < 32768',
+  0b010: 'out == 0',
+  0b011: 'out < 32768',
+  0b100: 'out >= 32768',
+  0b101: 'out != 0',
+  0b110: 'out == 0 or out >= 32768',
+  0b111: 'True',
+}
+
+_DEST_A = 0b100
+_DEST_D = 0b010
+_DEST_M = 0b001
+
+_COMP_FUNCTIONS = dict([(control, eval('lambda d, y: %s' % expression))
+                        for control, expression in _COMP_EXPRESSIONS.items()])
+_JUMP_FUNCTIONS = dict([(jump, eval('lambda out: %s' % condition))
+                        for jump, condition in _JUMP_CONDITIONS.items()])
+
+
+'''A ROM word, decoded once so that it need never be decoded again. An A-instruction has only its
+value. A C-instruction has the function computing its comp field from D and y, and the ALU control
+bits selecting it; whether y is M rather than A; its dest field as a mask of _DEST_A, _DEST_D and
+_DEST_M; and its jump field, with the function testing the ALU's output for it (None if it never
+jumps).'''
+class Instruction(object):
+  __slots__ = ('word', 'value', 'control', 'compute', 'use_m', 'dest', 'jump', 'condition')
+
+  def __init__(self, word):
+    self.word = word
+    if word & 0x8000:
+      self.value = None
+      self.control = (word >> 6) & 0b111111
+      self.compute = _COMP_FUNCTIONS[self.control]
+      self.use_m = bool(word & 0x1000)
+      self.dest = (word >> 3) & 0b111
+      self.jump = word & 0b111
+      self.condition = _JUMP_FUNCTIONS.get(self.jump)
+    else:
+      self.value = word
+      self.control = self.compute = self.use_m = self.dest = self.jump = self.condition = None
+
+
+'''Emulates the Hack computer running a program from ROM. Every ROM word is decoded into an
+Instruction when the program is loaded. The first time execution reaches an address, the
+instructions from there are compiled into a Python function (a block), which is cached by that
+address. A block runs on through conditional jumps, leaving the block if they are taken, and through
+unconditional jumps to addresses set by an A-instruction, up to an unconditional jump it cannot
+follow or a limit on its length. A is kept as a constant wherever an A-instruction has set it, and a
+block that jumps back to its own start loops without returning. run() then makes one call per block
+rather than decoding one instruction at a time; step() executes a single Instruction.
+
+RAM is an array of 16-bit words, with the screen mapped at SCREEN and the keyboard at KBD.'''
+class Emulator:
+  # Most instructions compiled into one block, so that a long run of instructions is not compiled
+  # again in full for every address that is jumped to within it.
+  _MAX_BLOCK_LENGTH = 64
+  # Stands in for the block at an address where the program halts.
+  _HALT = object()
+  _EMPTY_RAM = array('H', [0]) * RAM_SIZE
+
+  def __init__(self, words):
+    if len(words) > ROM_SIZE:
+      raise LoadError('Program of %d words does not fit in ROM of %d' % (len(words), ROM_SIZE))
+    self.program_length = len(words)
+    self.rom = array('H', words)
+    self.rom.extend([0] * (ROM_SIZE - len(words)))
+    # Programs repeat the same few words, so each distinct word is decoded only once.
+    decoded = {}
+    for word in set(self.rom):
+      decoded[word] = Instruction(word)
+    self.instructions = [decoded[word] for word in self.rom]
+    self.ram = array('H', [0]) * RAM_SIZE
+    self._block_functions = [None] * ROM_SIZE
+    # Most instructions each block executes before leaving or looping.
+    self._block_lengths = [0] * ROM_SIZE
+    self.reset()
+
+  '''Reset the CPU, as the reset input does: execution starts again at address 0. The A and D
+  registers and RAM are cleared too, so that every run starts from the same state.'''
+  def reset(self):
+    self.a = self.d = self.pc = 0
+    self.ram[:] = self._EMPTY_RAM
+    self.halted = False
+
+  '''Set the key code read from the keyboard (0 if no key is pressed).'''
+  def press(self, key):
+    self.ram[KBD] = key & _WORD_MASK
+
+  '''Execute the instruction at PC.'''
+  def step(self):
+    instruction = self.instructions[self.pc]
+    if instruction.value is not None:
+      self.a = instruction.value
+      self.pc = (self.pc + 1) & _ADDRESS_MASK
+      return
+
+    address = self.a & _ADDRESS_MASK
+    out = instruction.compute(self.d, self.ram[address] if instruction.use_m else self.a)
+    if instruction.condition and instruction.condition(out):
+      self.pc = address
+    else:
+      self.pc = (self.pc + 1) & _ADDRESS_MASK
+    if instruction.dest & _DEST_M:
+      self.ram[address] = out
+    if instruction.dest & _DEST_A:
+      self.a = out
+    if instruction.dest & _DEST_D:
+      self.d = out
+
+  '''Run until the program halts, by entering a loop that jumps to itself and has no other effect
+  (such as the usual "(END) @END 0;JMP") or by running past its last instruction, or until max_steps
+  instructions have been executed. Returns the number of instructions executed.'''
+  def run(self, max_steps=None):
+    if max_steps is None:
+      max_steps = sys.maxint
+    functions, lengths = self._block_functions, self._block_lengths
+    a, d, pc = self.a, self.d, self.pc
+    steps = 0
+    while True:
+      function = functions[pc]
+      if function is None:
+        self._compile_block(pc)
+        continue
+      if function is self._HALT:
+        self.halted = True
+        break
+      if steps + lengths[pc] > max_steps:
+        break
+      pc, a, d, executed = function(a, d, max_steps - steps)
+      steps += executed
+    self.a, self.d, self.pc = a, d, pc
+
+    # Finish with single instructions when fewer remain than the next block may execute. Whether
+    # the program has halted is checked even once none remain, as it may have just reached the end.
+    while not self.halted:
+      if functions[self.pc] is self._HALT or self._halts_at(self.pc):
+        self.halted = True
+      elif steps < max_steps:
+        self.step()
+        steps += 1
+      else:
+        break
+    return steps
+
+  '''Return whether the program halts on reaching address: whether it is past the last instruction,
+  or the start of the usual "(END) @END 0;JMP" loop.'''
+  def _halts_at(self, address):
+    if address >= self.program_length:
+      return True
+    load, jump = self.instructions[address], self.instructions[(address + 1) & _ADDRESS_MASK]
+    return load.value == address and jump.value is None and not jump.dest and jump.jump == 0b111
+
+  def _compile_block(self, start):
+    if self._halts_at(start):
+      self._block_functions[start] = self._HALT
+      return
+
+    lines = []
+    # The value of A if it was set by an A-instruction within the block, or None if it is only known
+    # at run time.
+    a = None
+    # Whether the block writes to a register or RAM, or may leave it by a conditional jump.
+    writes = exits = False
+    visited = set()
+    pc = start
+    length = 0
+    while True:
+      visited.add(pc)
+      instruction = self.instructions[pc]
+      pc += 1
+      length += 1
+      if instruction.value is not None:
+        a = instruction.value
+      elif instruction.dest or instruction.jump:
+        address = 'a & 32767' if a is None else str(a)
+        expression = _COMP_EXPRESSIONS[instruction.control]
+        if 'y' in expression:
+          y = 'ram[%s]' % address if instruction.use_m else ('a' if a is None else str(a))
+          expression = expression.replace('y', '(%s)' % y)
+        dest = instruction.dest
+        writes = writes or dest
+        # The jump is to the address in A before this instruction changes it.
+        target = a
+        target_expression = address
+        if instruction.jump and a is None and dest & _DEST_A:
+          lines.append('target = a & 32767')
+          target_expression = 'target'
+        # The output need only be kept in a variable if it is used more than once and is not one
+        # already (as it is for the common D;JGT and the like).
+        if expression == 'd' or not instruction.jump and dest in (_DEST_A, _DEST_D, _DEST_M):
+          out = expression
+        else:
+          lines.append('out = %s' % expression)
+          out = 'out'
+        if dest & _DEST_M:
+          lines.append('ram[%s] = %s' % (address, out))
+        if dest & _DEST_A:
+          lines.append('a = %s' % out)
+          a = None
+        if dest & _DEST_D:
+          lines.append('d = %s' % out)
+
+        if instruction.jump == 0b111:
+          if target == start and not writes and not exits:
+            # Jumping back to the start of a block that only loads A would loop forever. One that
+            # may leave by a conditional jump may not, even if it writes nothing, as what it tests
+            # can change between runs (as the keyboard does when a key is pressed).
+            self._block_functions[start] = self._HALT
+            return
+          if (target is not None and target not in visited and target < self.program_length and
+              length < self._MAX_BLOCK_LENGTH):
+            pc = target
+            continue
+          lines.extend(self._compile_exit(start, target, target_expression, a, length))
+          break
+        elif instruction.jump:
+          exits = True
+          lines.append('if %s:' % _JUMP_CONDITIONS[instruction.jump].replace('out', out))
+          exit_lines = self._compile_exit(start, target, target_expression, a, length)
+          lines.extend(['  ' + line for line in exit_lines])
+
+      # The instructions at which the program halts are left to a block of their own.
+      if self._halts_at(pc) or length == self._MAX_BLOCK_LENGTH:
+        lines.extend(self._compile_exit(start, pc & _ADDRESS_MASK, str(pc & _ADDRESS_MASK), a,
+                                        length))
+        break
+
+    source = ('def block(a, d, budget, ram=ram):\n'
+              '  executed = 0\n'
+              '  limit = budget - %d\n'
+              '  while True:\n'
+              '%s\n') % (length, '\n'.join(['    ' + line for line in lines]))
+    namespace = {'ram': self.ram}
+    exec compile(source, '<block %d>' % start, 'exec') in namespace
+    self._block_functions[start] = namespace['block']
+    self._block_lengths[start] = length
+
+  '''Return the lines leaving a block for target (an address, or None if only known at run time, in
+  which case target_expression computes it) after executing length of its instructions in this pass
+  through it, with a the value of A (as for _compile_block). A block jumping back to its own start
+  loops instead while its budget allows another pass.'''
+  def _compile_exit(self, start, target, target_expression, a, length):
+    a_expression = 'a' if a is None else str(a)
+    if target != start:
+      return ['return %s, %s, d, executed + %d' % (target_expression, a_expression, length)]
+    lines = ['executed += %d' % length]
+    if a is not None:
+      lines.append('a = %d' % a)
+    lines.extend(['if executed <= limit:', '  continue', 'return %d, a, d, executed' % start])
+    return lines
+
+  '''Write the screen as a binary PBM image, with set pixels black.'''
+  def write_screen(self, output):
+    output.write('P4\n%d %d\n' % (SCREEN_WIDTH, SCREEN_HEIGHT))
+    # The leftmost pixel of each word is its least significant bit, whereas it is the most
+    # significant bit of each byte of a PBM image.
+    reversed_bits = [int(format(i, '08b')[::-1], 2) for i in range(256)]
+    screen = self.ram[SCREEN:SCREEN + SCREEN_WIDTH * SCREEN_HEIGHT // 16]
+    output.write(''.join([chr(reversed_bits[word & 0xff]) + chr(reversed_bits[word >> 8])
+                          for word in screen]))
+
+
+'''Read a ROM image: a .bin file of raw 16-bit words in the given byte order, or otherwise a .hack
+file of one instruction per line, written in binary digits.'''
+def load_rom(filename, byte_order='little'):
+  words = array('H')
+  if filename.lower().endswith('.bin'):
+    with open(filename, 'rb') as rom:
+      image = rom.read()
+    if len(image) % 2:
+      raise LoadError('ROM image %s has an odd number of bytes' % filename)
+    words.fromstring(image)
+    if byte_order != sys.byteorder:
+      words.byteswap()
+  else:
+    with open(filename) as rom:
+      for line_number, line in enumerate(rom, 1):
+        line = line.strip()
+        if not line:
+          continue
+        if len(line) != 16 or line.strip('01'):
+          raise LoadError('Invalid instruction on line %d: %s' % (line_number, line))
+        words.append(int(line, 2))
+  return words
+
+def _signed(word):
+  return word - 0x10000 if word & 0x8000 else word
+
+def _ram_range(argument):
+  first, _, last = argument.partition('-')
+  try:
+    return int(first), int(last or first)
+  except ValueError:
+    raise argparse.ArgumentTypeError('invalid RAM range: %s' % argument)
+
+def _ram_assignment(argument):
+  address, _, value = argument.partition('=')
+  try:
+    return int(address), int(value)
+  except ValueError:
+    raise argparse.ArgumentTypeError('invalid RAM assignment: %s' % argument)
+
+
+if __name__ == '__main__':
+  arg_parser = argparse.ArgumentParser(description='Run Hack machine code.')
+  arg_parser.add_argument('path', help='.hack file, or .bin ROM image')
+  arg_parser.add_argument('--byte-order', choices=('little', 'big'), default='little',
+                          help='byte order of words in a .bin image (default: little)')
+  arg_parser.add_argument('--max-steps', type=int, default=None,
+                          help='stop after this many instructions if the program has not halted')
+  arg_parser.add_argument('--set', type=_ram_assignment, action='append', default=[],
+                          metavar='ADDRESS=VALUE',
+                          help='set RAM at an address before running (may be repeated)')
+  arg_parser.add_argument('--key', type=int, default=0,
+                          help='key code to read from the keyboard')
+  arg_parser.add_argument('--ram', type=_ram_range, action='append', default=[],
+                          metavar='FIRST[-LAST]',
+                          help='print the contents of RAM at these addresses once stopped '
+                               '(may be repeated)')
+  arg_parser.add_argument('--screen', metavar='FILE',
+                          help='write the screen to a PBM image once stopped')
+  args = arg_parser.parse_args()
+
+  emulator = Emulator(load_rom(args.path, args.byte_order))
+  for address, value in args.set:
+    emulator.ram[address] = value & _WORD_MASK
+  emulator.press(args.key)
+  start = time.time()
+  steps = emulator.run(args.max_steps)
+  elapsed = time.time() - start
+  sys.stderr.write('%s after %d instructions in %.3fs (%d instructions/s)\n' % (
+    emulator.halted and 'Halted' or 'Stopped', steps, elapsed, steps / max(elapsed, 1e-9)))
+  for first, last in args.ram:
+    for address in range(first, last + 1):
+      print 'RAM[%d] = %d' % (address, _signed(emulator.ram[address]))
+  if args.screen:
+    with open(args.screen, 'wb') as screen:
+      emulator.write_screen(screen)
@@ -1,6 +1,17 @@
 #!/usr/bin/env python
+import argparse
+import cPickle
+import errno
+import glob
+import hashlib
+import multiprocessing
+import os
 import re
+import struct
 import sys
+import time
+from array import array
+from collections import OrderedDict
 from os import path
 
 class ParseError(Exception):
@@ -11,74 +22,151 @@ class AssembleError(Exception):
 
 
 class SymbolTableBuilder:
-  def __init__(self, parser):
-    self._parser = parser
+  def __init__(self, commands):
+    self._commands = commands
 
   def build(self):
     count = 0
     symbol_table = SymbolTable()
 
-    while self._parser.has_more_commands():
-      self._parser.advance()
-      if self._parser.command_type() != 'L_COMMAND':
+    for command in self._commands:
+      if command.type != 'L_COMMAND':
         count += 1
       else:
-        symbol_table.add_entry(self._parser.symbol(), count)
+        symbol_table.add_entry(command.symbol, count)
     return symbol_table
 
 class Assembler:
   _WORD_LENGTH = 16
+  # Largest value that fits in an A-instruction, whose most significant bit must be zero.
+  _MAX_CONSTANT = (1 << (_WORD_LENGTH - 1)) - 1
+
+  # Number of instructions assembled in single-pass mode between checks for a prefix of the program
+  # that has no unresolved references, and so can be released to the caller.
+  _RELEASE_INTERVAL = 8192
+
+  def __init__(self, single_pass=False, source_map=False):
+    self._single_pass = single_pass
+    self._source_map = source_map
+
+  '''Assemble source, which may be a string or any iterable of lines. Returns the instructions as an
+  array of 16-bit words, the symbol table and, if a source map was requested, an array mapping each
+  ROM address to the source line number of its instruction (otherwise None).'''
+  def assemble(self, source):
+    source_lines = None
+    if self._single_pass:
+      commands = Parser(source)
+      if self._source_map:
+        source_lines = array('I')
+        commands = self._record_source_lines(commands, source_lines)
+      words = array('H')
+      for chunk in self._assemble_single_pass(commands):
+        words.extend(chunk)
+    else:
+      # Both passes work from the commands as parsed once, rather than parsing the source again.
+      commands = list(Parser(source))
+      words = self.encode(commands, SymbolTableBuilder(commands).build())
+      if self._source_map:
+        source_lines = array('I', [command.line for command in commands if command.type != 'L_COMMAND'])
+    return words, self._symbol_table, source_lines
+
+  def _record_source_lines(self, commands, source_lines):
+    for command in commands:
+      if command.type != 'L_COMMAND':
+        source_lines.append(command.line)
+      yield command
+
+  '''Assemble source in a single pass, calling write with each chunk of the program (as an array of
+  words) as soon as it is fully resolved. The source is read only once, but the program is held in
+  memory from its first unresolved reference onward, and a reference to a variable is unresolved
+  until the end of the source (until then, the symbol may yet be declared as a label). So for most
+  programs, which refer to a variable early on, the memory used grows with the whole program.
+  Returns the symbol table.'''
+  def assemble_stream(self, source, write):
+    for chunk in self._assemble_single_pass(Parser(source)):
+      write(chunk)
+    return self._symbol_table
+
+  '''Encode commands (as generated by Parser) as an array of 16-bit words, resolving symbols using
+  symbol_table, to which any variables are added. This is the second pass of two-pass assembly.'''
+  def encode(self, commands, symbol_table):
+    self._symbol_table = symbol_table
+    return self._assemble(commands)
+
+  def _assemble(self, commands):
+    words = array('H')
+    for command in commands:
+      if command.type == 'A_COMMAND':
+        words.append(self._build_a_command(command))
+      elif command.type == 'C_COMMAND':
+        words.append(self._build_c_command(command))
+    return words
+
+  '''Assemble the program while reading it only once, yielding it in chunks of words. A-instructions
+  that reference a symbol not yet seen are left as placeholders, with their ROM addresses recorded
+  against the symbol; these are patched when the symbol is declared as a label. Symbols still
+  unresolved at the end of the file are variables, and are allocated in order of first reference,
+  just as in the two-pass assembler. A chunk is yielded once no unresolved reference precedes its
+  end, which is never past the first reference to a variable.
+
+  Unlike the two-pass assembler, a label may not be declared more than once (or shadow a predefined
+  symbol), as earlier references to it would already have been resolved.'''
+  def _assemble_single_pass(self, commands):
+    self._symbol_table = SymbolTable()
+    # Instructions not yet yielded, the first of which is at ROM address base.
+    words = array('H')
+    base = 0
+    # Maps each unresolved symbol to the ROM addresses referencing it, in order of first reference.
+    unresolved = OrderedDict()
+    next_release = self._RELEASE_INTERVAL
+
+    for command in commands:
+      if command.type == 'L_COMMAND':
+        label = command.symbol
+        if self._symbol_table.contains(label):
+          raise AssembleError('Label %s already defined' % label)
+        self._symbol_table.add_entry(label, base + len(words))
+        self._patch_references(words, base, unresolved.pop(label, ()), base + len(words))
+      elif command.type == 'A_COMMAND':
+        if command.symbol is None or self._symbol_table.contains(command.symbol):
+          words.append(self._build_a_command(command))
+        else:
+          unresolved.setdefault(command.symbol, []).append(base + len(words))
+          words.append(0)
+      else:
+        words.append(self._build_c_command(command))
+
+      if base + len(words) >= next_release:
+        next_release += self._RELEASE_INTERVAL
+        # References to each symbol are recorded in ascending order, so the first is the earliest.
+        resolved = min([references[0] for references in unresolved.values()] or [base + len(words)])
+        if resolved > base:
+          yield words[:resolved - base]
+          words = words[resolved - base:]
+          base = resolved
+
+    for symbol, references in unresolved.items():
+      self._symbol_table.add_variable(symbol)
+      self._patch_references(words, base, references, self._symbol_table.get_address(symbol))
+    yield words
 
-  def __init__(self, filename):
-    self._parser = Parser(filename)
-    self._symbol_table = SymbolTableBuilder(self._parser).build()
-    self._parser.reset()
-
-    self._assembled = open(self._determine_assembled_filename(filename), 'w')
-    self._assemble()
-
-    self._parser.close()
-    self._assembled.close()
-
-  '''If assembly filename ends in .asm, output file will change this extension to .hack. Otherwise,
-  .hack extension will simply be appended to assembly filename.'''
-  def _determine_assembled_filename(self, assembly_filename):
-    assembled_ext = '.hack'
-    assembled_filename = re.compile(r'\.asm$', re.IGNORECASE).sub(assembled_ext, assembly_filename)
-    if not assembled_filename.endswith(assembled_ext):
-      assembled_filename += assembled_ext
-    return assembled_filename
-
-  def _assemble(self):
-    while self._parser.has_more_commands():
-      self._parser.advance()
-      command_type = self._parser.command_type()
-      if command_type == 'L_COMMAND':
-        continue
+  def _patch_references(self, words, base, references, address):
+    word = self._build_a_command_constant(address)
+    for reference in references:
+      words[reference - base] = word
 
-      command = {
-        'A_COMMAND': self._build_a_command,
-        'C_COMMAND': self._build_c_command,
-      }[command_type]()
-      self._assembled.write(command + '\n')
-
-  def _build_a_command(self):
-    # Need extra bit to indicate instruction is an A instruction
-    symbol = self._parser.symbol()
-    if symbol.isdigit():
-      return self._build_a_command_constant(symbol)
-    # Note that no checking of the symbol is done to ensure it conforms to allowed symbol
-    # characters. It may, for example start with a digit, which is against the spec.
+  def _build_a_command(self, command):
+    if command.symbol is None:
+      return self._build_a_command_constant(command.constant)
     else:
-      return self._build_a_command_reference(symbol)
+      return self._build_a_command_reference(command.symbol)
 
+  # An A-instruction is simply its value, as the most significant bit (which must be zero to
+  # indicate an A-instruction) is guaranteed to be clear for any value that fits.
   def _build_a_command_constant(self, constant):
-    max_length = self._WORD_LENGTH - 1
-    binary_value = self._convert_denary_to_binary(constant)
-    if len(binary_value) > max_length:
-      raise AssembleError('Constant %s cannot fit in %s available bits' % (constant, max_length))
-    # Pad with leading zeroes
-    return '0%s%s' % ('0'*(max_length - len(binary_value)), binary_value)
+    if constant > self._MAX_CONSTANT:
+      raise AssembleError('Constant %s cannot fit in %s available bits' % (constant, self._WORD_LENGTH - 1))
+    return constant
 
   def _build_a_command_reference(self, symbol):
     if not self._symbol_table.contains(symbol):
@@ -86,124 +174,281 @@ class Assembler:
     address = self._symbol_table.get_address(symbol)
     return self._build_a_command_constant(address)
 
-  def _build_c_command(self):
-    return '%s%s%s%s' % (
-      '111',
-       Code.comp(self._parser.comp()),
-       Code.dest(self._parser.dest()),
-       Code.jump(self._parser.jump()),
-    )
-
-  # I'm sure Python's standard library includes a means of doing this, but I'm rolling my own since
-  # the intent of this project is to learn.
-  def _convert_denary_to_binary(self, i):
-    binary = ''
-    i = int(i)
-    while True:
-      binary = '%s%s' % (i % 2, binary)
-      i /= 2
-      if i == 0:
-        return binary
-
+  def _build_c_command(self, command):
+    if Code.is_c_instruction(command.text):
+      return Code.c_instruction(command.text)
+    # Not a valid instruction, so check its fields individually to report which one is invalid.
+    for kind, mnemonic in (('comp', command.comp), ('dest', command.dest), ('jump', command.jump)):
+      if mnemonic not in CInstructionCodes.CODES[kind]:
+        raise ParseError('Invalid %s: %s' % (kind, mnemonic))
+    raise ParseError('Invalid instruction: %s' % command.text)
+
+
+'''Writes instructions as text, one line of sixteen binary digits per instruction. Instructions are
+kept as 16-bit integers throughout assembly; they are only formatted as text here.'''
+class TextWriter:
+  EXTENSION = '.hack'
+  FILE_MODE = 'w'
+  # Number of instructions formatted and written at a time.
+  _CHUNK_LENGTH = 8192
+  # Binary digits of every byte value, so that a word can be formatted with two lookups.
+  _BYTE_DIGITS = [format(i, '08b') for i in range(256)]
+
+  def write(self, words, output):
+    digits = self._BYTE_DIGITS
+    for start in range(0, len(words), self._CHUNK_LENGTH):
+      chunk = words[start:start + self._CHUNK_LENGTH]
+      output.write(''.join([digits[word >> 8] + digits[word & 0xff] + '\n' for word in chunk]))
+
+
+'''Writes instructions as a raw ROM image of 16-bit words in the given byte order, which can be
+loaded (or mapped) without parsing.'''
+class BinaryWriter:
+  EXTENSION = '.bin'
+  FILE_MODE = 'wb'
+  BYTE_ORDERS = ('little', 'big')
+
+  def __init__(self, byte_order='little'):
+    if byte_order not in self.BYTE_ORDERS:
+      raise ValueError('Unknown byte order: %s' % byte_order)
+    self._byte_order = byte_order
+
+  def write(self, words, output):
+    if self._byte_order != sys.byteorder:
+      words = array('H', words)
+      words.byteswap()
+    output.write(words.tostring())
+
+
+'''Writes a source map: a sidecar file mapping each ROM address to the source line of its instruction,
+along with the labels and variables in the symbol table, so that tools can attribute ROM addresses
+to source lines without parsing the source. The file consists of a header (magic number, format
+version and instruction count), the line number of each instruction as a little-endian 32-bit
+word, then one "L address symbol" or "V address symbol" line per label or variable.'''
+class SourceMapWriter:
+  EXTENSION = '.map'
+  FILE_MODE = 'wb'
+  MAGIC = 'HKMP'
+  VERSION = 1
+  _HEADER = struct.Struct('<4sHI')
+
+  def write(self, source_lines, symbol_table, output):
+    output.write(self._HEADER.pack(self.MAGIC, self.VERSION, len(source_lines)))
+    source_lines = array('I', source_lines)
+    if sys.byteorder != 'little':
+      source_lines.byteswap()
+    output.write(source_lines.tostring())
+
+    symbols = ['L %d %s\n' % (address, label) for label, address in sorted(symbol_table.labels().items(),
+                                                                         key=lambda item: item[1])]
+    symbols += ['V %d %s\n' % (address, variable) for variable, address in symbol_table.variables().items()]
+    output.write(''.join(symbols))
+
+  '''Read a source map written by write(). Returns an array mapping ROM addresses to line numbers,
+  and dictionaries mapping labels and variables to their addresses.'''
+  @classmethod
+  def read(cls, input):
+    magic, version, count = cls._HEADER.unpack(input.read(cls._HEADER.size))
+    if magic != cls.MAGIC or version != cls.VERSION:
+      raise ValueError('Not a version %d source map' % cls.VERSION)
+    source_lines = array('I')
+    source_lines.fromstring(input.read(count * source_lines.itemsize))
+    if sys.byteorder != 'little':
+      source_lines.byteswap()
+
+    labels, variables = {}, OrderedDict()
+    for line in input:
+      kind, address, symbol = line.rstrip('\n').split(' ', 2)
+      (labels if kind == 'L' else variables)[symbol] = int(address)
+    return source_lines, labels, variables
+
+
+'''An on-disk cache of pickled payloads, keyed by hashes, that evicts entries least recently used
+first once the cache exceeds max_size bytes. Entries are written atomically, so a cache directory
+may be shared by concurrent processes. Subclasses set the version, which is part of every key, and
+the extension of the entry files, and hash their keys with _digest.'''
+class DiskCache:
+  # Bump whenever a change could change what is cached, so that stale entries are never used.
+  _VERSION = 1
+  _ENTRY_EXTENSION = '.cache'
+
+  def __init__(self, directory, max_size=64 * 1024 * 1024):
+    self._directory = directory
+    self._max_size = max_size
+    if not os.path.isdir(directory):
+      os.makedirs(directory)
+
+  '''Return a key hashing the version, the fields (separated by colons) and then the strings in
+  data.'''
+  def _digest(self, fields, data):
+    digest = hashlib.sha1(''.join(['%s:' % field for field in [self._VERSION] + fields]))
+    for string in data:
+      digest.update(string)
+    return digest.hexdigest()
+
+  '''Return the payload cached for key, or None if there is no such entry.'''
+  def get(self, key):
+    entry_path = self._entry_path(key)
+    try:
+      with open(entry_path, 'rb') as entry:
+        payload = cPickle.load(entry)
+      # Mark entry as recently used.
+      os.utime(entry_path, None)
+    except (EnvironmentError, EOFError, cPickle.UnpicklingError):
+      return None
+    return payload
+
+  # Only plain data should be stored, as instances would be pickled along with the name of the
+  # module defining their class, which differs when a file is run as a script.
+  def put(self, key, payload):
+    entry_path = self._entry_path(key)
+    temp_path = '%s.%s.tmp' % (entry_path, os.getpid())
+    with open(temp_path, 'wb') as entry:
+      cPickle.dump(payload, entry, cPickle.HIGHEST_PROTOCOL)
+    os.rename(temp_path, entry_path)
+    self._evict()
+
+  def _entry_path(self, key):
+    return os.path.join(self._directory, key + self._ENTRY_EXTENSION)
+
+  def _evict(self):
+    entries = []
+    for filename in os.listdir(self._directory):
+      if not filename.endswith(self._ENTRY_EXTENSION):
+        continue
+      entry_path = os.path.join(self._directory, filename)
+      try:
+        stat = os.stat(entry_path)
+      except OSError:
+        # Already evicted by another process.
+        continue
+      entries.append((stat.st_mtime, stat.st_size, entry_path))
 
-class Parser:
-  def __init__(self, filename):
-    self._file = open(filename)
-    self.reset()
-
-  def has_more_commands(self):
-    return self._next_command != None
-
-  def advance(self):
-    # Store both the current command and the next one to allow us to determine whether a valid
-    # command follows the current one. (This is necessary for has_more_commands() to work.)
-   
-    # This is more reliable than determining if the current position in the file is equal to its
-    # size -- consider if file ends in blank line or comment, in which case we would think that we're
-    # not at the end of the file (and report as such from has_more_commands()), even though no more
-    # valid commands would follow.
-    self._command = self._next_command
-    self._read_next_command()
-
-  def _read_next_command(self):
-    while True:
-      command = self._file.readline()
-      # EOF
-      if not command:
-        self._next_command = None
+    total_size = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+      if total_size <= self._max_size:
         break
+      try:
+        os.remove(entry_path)
+      except OSError as e:
+        if e.errno != errno.ENOENT:
+          raise
+      total_size -= size
+
+
+'''A DiskCache of assembled programs, keyed by a hash of their source, so that an unchanged program
+can be reassembled without being parsed.'''
+class AssemblyCache(DiskCache):
+  _VERSION = 2
+
+  def key(self, source, single_pass, source_map):
+    return self._digest([single_pass and 'single' or 'two', source_map], [source])
+
+  '''Return the (words, symbol_table, source_lines) cached for key, or None if there is no such
+  entry.'''
+  def get(self, key):
+    payload = DiskCache.get(self, key)
+    if payload is None:
+      return None
+    words_string, symbol_table_state, source_lines_string = payload
+
+    words = array('H')
+    words.fromstring(words_string)
+    symbol_table = SymbolTable()
+    vars(symbol_table).update(symbol_table_state)
+    source_lines = None
+    if source_lines_string is not None:
+      source_lines = array('I')
+      source_lines.fromstring(source_lines_string)
+    return words, symbol_table, source_lines
+
+  def put(self, key, words, symbol_table, source_lines):
+    source_lines_string = source_lines.tostring() if source_lines is not None else None
+    DiskCache.put(self, key, (words.tostring(), vars(symbol_table), source_lines_string))
+
+
+'''A single command, classified when it is read so that it need never be parsed again. A-commands
+have either a symbol or a constant; L-commands have a symbol; and C-commands have dest, comp and jump
+mnemonics (dest and jump being None if absent). Every command retains its text, with comments and
+surrounding whitespace removed, and the number of the source line on which it appeared.'''
+class Command(object):
+  __slots__ = ('type', 'text', 'line', 'symbol', 'constant', 'dest', 'comp', 'jump')
+
+  def __init__(self, type, text, line, symbol=None, constant=None, dest=None, comp=None, jump=None):
+    self.type = type
+    self.text = text
+    self.line = line
+    self.symbol = symbol
+    self.constant = constant
+    self.dest = dest
+    self.comp = comp
+    self.jump = jump
+
+
+'''Parses assembly from a string, or from any iterable of lines (such as a list or an open file),
+generating a Command for each line containing one.'''
+class Parser:
+  _SYMBOL_CHARACTERS = frozenset('abcdefghijklmnopqrstuvwxyzABCDEFGHIJKLMNOPQRSTUVWXYZ0123456789_.$:')
+
+  def __init__(self, source):
+    if isinstance(source, basestring):
+      source = source.splitlines()
+    self._source = source
 
+  def __iter__(self):
+    for line_number, line in enumerate(self._source, 1):
       # Strip comment from line if present, as well as any extraneous whitespace.
-      command = command[:command.find('//')].strip()
-      # Read until non-whitespace line found.
+      comment_start = line.find('//')
+      if comment_start != -1:
+        line = line[:comment_start]
+      command = line.strip()
+      # Skip lines without a command.
       if command:
-        self._next_command = command
-        break
-
-  def command_type(self):
-    if self._command.startswith('@'):
-      return 'A_COMMAND'
-    elif self._command.startswith('('):
-      return 'L_COMMAND'
+        yield self._parse_command(command, line_number)
+
+  def _parse_command(self, command, line_number):
+    first = command[0]
+    if first == '@':
+      symbol = self._parse_symbol(command, command[1:])
+      if symbol.isdigit():
+        return Command('A_COMMAND', command, line_number, constant=int(symbol))
+      # Note that no checking of the symbol is done to ensure it does not start with a digit, which
+      # is against the spec.
+      return Command('A_COMMAND', command, line_number, symbol=symbol)
+    elif first == '(':
+      if not command.endswith(')'):
+        raise ParseError('Unterminated label: %s' % command)
+      return Command('L_COMMAND', command, line_number, symbol=self._parse_symbol(command, command[1:-1]))
     else:
-      return 'C_COMMAND'
-
-  def symbol(self):
-    return re.search(r'[(@]([a-zA-Z0-9_.$:]+)\)?', self._command).group(1)
+      return self._parse_c_command(command, line_number)
 
-  def dest(self):
-    return self._parse_mnemonic('dest')
+  def _parse_symbol(self, command, symbol):
+    if not symbol or not self._SYMBOL_CHARACTERS.issuperset(symbol):
+      raise ParseError('Invalid symbol: %s' % command)
+    return symbol
 
-  def comp(self):
-    return self._parse_mnemonic('comp')
-
-  def jump(self):
-    return self._parse_mnemonic('jump')
-
-  def close(self):
-    self._file.close()
-
-  def reset(self):
-    self._file.seek(0)
-    # Must read "next" command to allow has_more_commands() to work before call to advance().
-    self._read_next_command()
- 
-  def _parse_mnemonic(self, kind):
-    components = self._split_c_command()
-    if components[kind] not in CInstructionCodes.CODES[kind]:
-      raise ParseError('Invalid %s: %s' % (kind, components[kind]))
-    return components[kind]
-
-  def _split_c_command(self):
+  def _parse_c_command(self, command, line_number):
     # Regular expressions quickly turn into a quaqmire for this task. This code is slightly longer,
     # but clearer.
-    parts = self._command.split('=', 1)
-    if len(parts) > 1:
-      dest, comp = parts
-    else:
-      dest, comp = None, parts[0]
+    dest, equals, comp = command.partition('=')
+    if not equals:
+      dest, comp = None, command
 
-    parts = comp.split(';', 1)
-    if len(parts) > 1:
-      comp, jump = parts
-    else:
-      comp, jump = parts[0], None
+    comp, semicolon, jump = comp.partition(';')
+    if not semicolon:
+      jump = None
 
-    return {'dest': dest, 'comp': comp, 'jump': jump}
+    return Command('C_COMMAND', command, line_number, dest=dest, comp=comp, jump=jump)
 
 
 class Code:
   @staticmethod
-  def dest(mnemonic):
-    return CInstructionCodes.CODES['dest'][mnemonic]
+  def is_c_instruction(command):
+    return command in CInstructionCodes.INSTRUCTIONS
 
   @staticmethod
-  def comp(mnemonic):
-    return CInstructionCodes.CODES['comp'][mnemonic]
-
-  @staticmethod
-  def jump(mnemonic):
-    return CInstructionCodes.CODES['jump'][mnemonic]
+  def c_instruction(command):
+    return CInstructionCodes.INSTRUCTIONS[command]
 
 
 class SymbolTable:
@@ -220,6 +465,9 @@ class SymbolTable:
     # Add R0 through R15 to symbol table.
     for i in range(16):
       self._table['R%s' % i] = i
+    self._predefined = frozenset(self._table)
+    # Variables in the order they were added, to distinguish them from labels.
+    self._variables = []
     # Base address for previously undeclared variable symbols. By default, set to first address
     # after predefined symbols.
     self._variable_base = 16
@@ -229,6 +477,7 @@ class SymbolTable:
 
   def add_variable(self, symbol):
     self.add_entry(symbol, self._variable_base)
+    self._variables.append(symbol)
     self._variable_base += 1
 
   def contains(self, symbol):
@@ -237,6 +486,14 @@ class SymbolTable:
   def get_address(self, symbol):
     return self._table[symbol]
 
+  def labels(self):
+    variables = set(self._variables)
+    return dict([(symbol, address) for symbol, address in self._table.items()
+                 if symbol not in self._predefined and symbol not in variables])
+
+  def variables(self):
+    return OrderedDict([(symbol, self._table[symbol]) for symbol in self._variables])
+
 
 class CInstructionCodes:
   CODES = {
@@ -280,6 +537,14 @@ class CInstructionCodes:
       'M-D': '1000111',
       'D&M': '1000000',
       'D|M': '1010101',
+      # Commutative operations may also be written with their operands the other way around (as the
+      # VM translator writes them).
+      'A+D': '0000010',
+      'A&D': '0000000',
+      'A|D': '0010101',
+      'M+D': '1000010',
+      'M&D': '1000000',
+      'M|D': '1010101',
     },
 
     'jump': {
@@ -295,5 +560,182 @@ class CInstructionCodes:
   }
 
 
+  '''Every valid C-instruction, keyed by its text (e.g. "D=M;JGT"), mapped to its 16-bit encoding.
+  Precomputing this means an instruction need neither be split into its fields nor have its fields'
+  bit strings joined in order to be assembled.'''
+  @classmethod
+  def _build_instructions(cls):
+    instructions = {}
+    for dest, dest_bits in cls.CODES['dest'].items():
+      for comp, comp_bits in cls.CODES['comp'].items():
+        for jump, jump_bits in cls.CODES['jump'].items():
+          command = comp
+          if dest:
+            command = '%s=%s' % (dest, command)
+          if jump:
+            command = '%s;%s' % (command, jump)
+          instructions[command] = int('111' + comp_bits + dest_bits + jump_bits, 2)
+    return instructions
+
+CInstructionCodes.INSTRUCTIONS = CInstructionCodes._build_instructions()
+
+
+'''Assemble source, which may be a string or any iterable of lines, without touching disk (other
+than the AssemblyCache, if given). Returns the instructions as an array of 16-bit words, the symbol
+table and, if source_map is true, an array mapping each ROM address to a source line number
+(otherwise None). The cache is only used when source is a string, as other sources would have to be
+read in full to be hashed.'''
+def assemble(source, single_pass=False, cache=None, source_map=False):
+  if cache is None or not isinstance(source, basestring):
+    return Assembler(single_pass, source_map).assemble(source)
+
+  key = cache.key(source, single_pass, source_map)
+  result = cache.get(key)
+  if result is None:
+    result = Assembler(single_pass, source_map).assemble(source)
+    cache.put(key, *result)
+  return result
+
+'''Assemble the file at filename, writing the result (and, if source_map is true, a source map)
+alongside it. Returns the name of the file written.'''
+def assemble_file(filename, single_pass=False, writer=None, cache=None, source_map=False):
+  writer = writer or TextWriter()
+  with open(filename) as source:
+    if cache is not None:
+      # Read whole source so that it can be hashed to look it up in the cache.
+      source = source.read()
+    words, symbol_table, source_lines = assemble(source, single_pass, cache, source_map)
+
+  assembled_filename = _determine_assembled_filename(filename, writer.EXTENSION)
+  with open(assembled_filename, writer.FILE_MODE) as assembled:
+    writer.write(words, assembled)
+  if source_map:
+    source_map_writer = SourceMapWriter()
+    with open(_determine_assembled_filename(filename, source_map_writer.EXTENSION),
+              source_map_writer.FILE_MODE) as map_file:
+      source_map_writer.write(source_lines, symbol_table, map_file)
+  return assembled_filename
+
+'''Assemble every file named by paths, which may be files, directories (whose .asm files are
+assembled) or glob patterns, across a pool of jobs worker processes (by default, or if jobs is 0,
+one per CPU). Remaining options are passed to assemble_file(). A file that fails to assemble does
+not stop the batch. Returns a list of (filename, error, seconds) tuples in the order the files were
+found, with error being None for files assembled successfully.'''
+def assemble_batch(paths, jobs=None, **options):
+  filenames = find_assembly_files(paths)
+  tasks = [(filename, options) for filename in filenames]
+  if jobs == 1:
+    return [_assemble_batch_file(task) for task in tasks]
+
+  pool = multiprocessing.Pool(jobs or None)
+  try:
+    # Hand out files in chunks to reduce inter-process overhead when there are many small ones.
+    chunk_size = max(1, len(tasks) // (4 * (jobs or multiprocessing.cpu_count())))
+    return pool.map(_assemble_batch_file, tasks, chunk_size)
+  finally:
+    pool.close()
+    pool.join()
+
+def find_assembly_files(paths):
+  filenames = []
+  for path in paths:
+    if os.path.isdir(path):
+      found = [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.lower().endswith('.asm')]
+      if not found:
+        raise IOError('No .asm files in directory %s' % path)
+    elif glob.has_magic(path):
+      found = sorted(glob.glob(path))
+      if not found:
+        raise IOError('No files match %s' % path)
+    elif os.path.isfile(path):
+      found = [path]
+    else:
+      raise IOError('%s is not a file or directory' % path)
+    filenames.extend(found)
+  return filenames
+
+'''Assemble source (a string or any iterable of lines, such as sys.stdin) in a single pass, writing
+each chunk of the program to the file-like object output as soon as it is resolved (which, as
+Assembler.assemble_stream explains, is usually only at the end). Returns the symbol table.'''
+def assemble_stream(source, output, writer=None):
+  writer = writer or TextWriter()
+  return Assembler(single_pass=True).assemble_stream(source,
+                                                     lambda words: writer.write(words, output))
+
+def _assemble_batch_file(task):
+  filename, options = task
+  start = time.time()
+  try:
+    assemble_file(filename, **options)
+  except (ParseError, AssembleError, EnvironmentError) as e:
+    return filename, '%s: %s' % (e.__class__.__name__, e), time.time() - start
+  return filename, None, time.time() - start
+
+def _report_batch(results, elapsed):
+  failures = [(filename, error) for filename, error, _ in results if error]
+  for filename, error in failures:
+    sys.stderr.write('%s: %s\n' % (filename, error))
+  sys.stderr.write('Assembled %d of %d files (%d failed) in %.2fs (%.2fs across workers)\n' % (
+    len(results) - len(failures),
+    len(results),
+    len(failures),
+    elapsed,
+    sum(seconds for _, _, seconds in results),
+  ))
+  return not failures
+
+'''If assembly filename ends in .asm, output file will change this extension to that of the output
+format (.hack by default). Otherwise, the extension will simply be appended to assembly filename.'''
+def _determine_assembled_filename(assembly_filename, assembled_ext):
+  assembled_filename = re.compile(r'\.asm$', re.IGNORECASE).sub(assembled_ext, assembly_filename)
+  if not assembled_filename.endswith(assembled_ext):
+    assembled_filename += assembled_ext
+  return assembled_filename
+
+
 if __name__ == '__main__':
-  Assembler(sys.argv[1])
+  arg_parser = argparse.ArgumentParser(description='Assemble Hack assembly into Hack machine code.')
+  arg_parser.add_argument('paths', nargs='+', metavar='path',
+                          help='assembly file to assemble; several files, directories or glob patterns '
+                               'are assembled as a batch, and - streams standard input to standard output '
+                               'in a single pass')
+  arg_parser.add_argument('--single-pass', action='store_true',
+                          help='read the assembly file once, backpatching forward label references')
+  arg_parser.add_argument('--format', choices=('text', 'bin'), default='text',
+                          help='write a .hack text file (default), or a .bin image of raw 16-bit words')
+  arg_parser.add_argument('--byte-order', choices=BinaryWriter.BYTE_ORDERS, default='little',
+                          help='byte order of words in a .bin image (default: little)')
+  arg_parser.add_argument('-j', '--jobs', type=int, default=None,
+                          help='number of worker processes for a batch (default or 0: one per CPU)')
+  arg_parser.add_argument('--cache-dir',
+                          help='directory in which to cache assembled programs by a hash of their source')
+  arg_parser.add_argument('--cache-size', type=int, default=64,
+                          help='size in megabytes beyond which the least recently used cache entries are '
+                               'evicted (default: 64)')
+  arg_parser.add_argument('--source-map', action='store_true',
+                          help='also write a .map file mapping ROM addresses to source lines, along with '
+                               'the labels and variables')
+  args = arg_parser.parse_args()
+  if args.source_map and args.paths == ['-']:
+    arg_parser.error('--source-map cannot be used when streaming')
+
+  if args.format == 'bin':
+    writer = BinaryWriter(args.byte_order)
+  else:
+    writer = TextWriter()
+  if args.cache_dir:
+    cache = AssemblyCache(args.cache_dir, args.cache_size * 1024 * 1024)
+  else:
+    cache = None
+
+  if args.paths == ['-']:
+    assemble_stream(sys.stdin, sys.stdout, writer)
+  elif len(args.paths) == 1 and os.path.isfile(args.paths[0]):
+    assemble_file(args.paths[0], single_pass=args.single_pass, writer=writer, cache=cache,
+                  source_map=args.source_map)
+  else:
+    start = time.time()
+    results = assemble_batch(args.paths, jobs=args.jobs, single_pass=args.single_pass, writer=writer,
+                             cache=cache, source_map=args.source_map)
+    if not _report_batch(results, time.time() - start):
+      sys.exit(1)
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import sys
+import time
+
+from assembler import Assembler, BinaryWriter, Parser, SymbolTableBuilder, TextWriter
+
+'''Generates synthetic assembly programs with a realistic mix of labels, variables, predefined
+symbols, constants and C-instructions, laid out as hand-written programs are: indented
+instructions, trailing comments, comment lines and blank lines between blocks.'''
+class ProgramGenerator:
+  # Largest ROM address a label can be assigned, as label addresses must fit in an A-instruction.
+  _MAX_LABEL_ADDRESS = 0x7fff
+
+  _PREDEFINED_SYMBOLS = ['SP', 'LCL', 'ARG', 'THIS', 'THAT', 'SCREEN', 'KBD', 'R0', 'R1', 'R13',
+                         'R14', 'R15']
+
+  # Weighted towards the instructions that dominate real programs.
+  _COMMON_C_INSTRUCTIONS = [
+    'D=M', 'D=A', 'M=D', 'A=M', 'AM=M-1', 'M=M+1', 'M=M-1', 'D=D+M', 'D=M-D', 'A=D+A', 'M=0',
+    'M=-1', 'D;JGT', 'D;JEQ', 'D;JLT', 'D;JNE', 'D;JLE', '0;JMP', 'MD=M-1', 'D=D-A', 'M=D|M',
+    'M=!M',
+  ]
+
+  def __init__(self, seed=0):
+    self._random = random.Random(seed)
+
+  '''Return the lines of a program of instruction_count instructions.'''
+  def generate(self, instruction_count):
+    r = self._random
+    label_count = max(1, instruction_count // 25)
+    variable_count = max(1, min(1000, instruction_count // 200))
+
+    # Labels may only be declared where their address fits in an A-instruction, but programs may be
+    # longer than the ROM.
+    addresses = range(min(instruction_count, self._MAX_LABEL_ADDRESS + 1))
+    label_addresses = sorted(r.sample(addresses, min(label_count, len(addresses))))
+    labels = ['BLOCK_%d' % i for i in range(len(label_addresses))]
+    variables = ['var%d' % i for i in range(variable_count)]
+
+    lines = ['// Synthetic program of %d instructions' % instruction_count, '']
+    next_label = 0
+    for address in range(instruction_count):
+      while next_label < len(label_addresses) and label_addresses[next_label] == address:
+        lines.append('')
+        lines.append('(%s)' % labels[next_label])
+        next_label += 1
+
+      roll = r.random()
+      if roll < 0.04:
+        lines.append('')
+      elif roll < 0.08:
+        lines.append('// Comment before instruction %d' % address)
+
+      if r.random() < 0.45:
+        instruction = '@%s' % self._a_instruction_operand(labels, variables)
+      else:
+        instruction = self._c_instruction()
+      if r.random() < 0.15:
+        instruction = '%-22s// Trailing comment' % instruction
+      lines.append('  %s' % instruction)
+    return lines
+
+  def _a_instruction_operand(self, labels, variables):
+    roll = self._random.random()
+    if roll < 0.4:
+      return self._random.choice(labels)
+    elif roll < 0.65:
+      return self._random.choice(variables)
+    elif roll < 0.8:
+      return self._random.choice(self._PREDEFINED_SYMBOLS)
+    else:
+      return self._random.randrange(0x8000)
+
+  def _c_instruction(self):
+    return self._random.choice(self._COMMON_C_INSTRUCTIONS)
+
+
+'''Times each phase of assembling a program: parsing, the symbol pass, the encoding pass and
+writing, as well as single-pass assembly as a whole. Each phase is timed repeat times and the
+fastest time kept.'''
+class Benchmark:
+  def __init__(self, repeat=3):
+    self._repeat = repeat
+
+  def run(self, lines):
+    timings = {}
+    commands = self._time(timings, 'parse', lambda: list(Parser(lines)))
+    self._time(timings, 'symbol_pass', lambda: SymbolTableBuilder(commands).build())
+    # Encoding adds variables to the symbol table, so each encode pass needs a fresh one.
+    words = self._time(timings, 'encode_pass',
+                       lambda symbol_table: Assembler().encode(commands, symbol_table),
+                       setup=lambda: SymbolTableBuilder(commands).build())
+
+    with open(os.devnull, 'wb') as output:
+      self._time(timings, 'write_text', lambda: TextWriter().write(words, output))
+      self._time(timings, 'write_bin', lambda: BinaryWriter().write(words, output))
+    self._time(timings, 'single_pass', lambda: Assembler(single_pass=True).assemble(lines))
+
+    two_pass = (timings['parse'] + timings['symbol_pass'] + timings['encode_pass'] +
+                timings['write_text'])
+    return {
+      'lines': len(lines),
+      'instructions': len(words),
+      'seconds': timings,
+      'instructions_per_second': {
+        'two_pass': len(words) / two_pass,
+        'single_pass': len(words) / (timings['single_pass'] + timings['write_text']),
+      },
+    }
+
+  '''Time f, passing it the result of setup (if given), which is not timed.'''
+  def _time(self, timings, phase, f, setup=None):
+    best = None
+    for _ in range(self._repeat):
+      if setup:
+        args = (setup(),)
+      else:
+        args = ()
+      start = time.time()
+      result = f(*args)
+      elapsed = time.time() - start
+      if best is None or elapsed < best:
+        best = elapsed
+    timings[phase] = best
+    return result
+
+
+def _benchmark_size(task):
+  instruction_count, seed, repeat, programs_dir = task
+  lines = ProgramGenerator(seed).generate(instruction_count)
+  if programs_dir:
+    with open(os.path.join(programs_dir, 'Synthetic%d.asm' % instruction_count), 'w') as program:
+      program.write('\n'.join(lines) + '\n')
+
+  result = Benchmark(repeat).run(lines)
+  # Each size is benchmarked in a fresh process, so the peak resident set size is that of generating
+  # and assembling this program alone. (Linux reports it in kilobytes.)
+  result['peak_memory_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  return result
+
+def run_benchmarks(sizes, seed=0, repeat=3, programs_dir=None):
+  results = []
+  for size in sizes:
+    pool = multiprocessing.Pool(1)
+    try:
+      results.append(pool.apply(_benchmark_size, ((size, seed, repeat, programs_dir),)))
+    finally:
+      pool.close()
+      pool.join()
+  return {
+    'benchmark': 'assembler',
+    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'python': platform.python_version(),
+    'seed': seed,
+    'repeat': repeat,
+    'results': results,
+  }
+
+def _report(report):
+  phases = ('parse', 'symbol_pass', 'encode_pass', 'write_text', 'write_bin', 'single_pass')
+  sys.stderr.write('%12s %s %14s %14s %10s\n' % (
+    'instructions', ' '.join(['%12s' % phase for phase in phases]), 'two-pass/s', 'single-pass/s',
+    'peak KB'))
+  for result in report['results']:
+    sys.stderr.write('%12d %s %14d %14d %10d\n' % (
+      result['instructions'],
+      ' '.join(['%11.4fs' % result['seconds'][phase] for phase in phases]),
+      result['instructions_per_second']['two_pass'],
+      result['instructions_per_second']['single_pass'],
+      result['peak_memory_kb'],
+    ))
+
+
+if __name__ == '__main__':
+  arg_parser = argparse.ArgumentParser(description='Benchmark the assembler on synthetic programs.')
+  arg_parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 32768, 100000],
+                          help='numbers of instructions in the programs generated '
+                               '(default: 1000 10000 32768 100000)')
+  arg_parser.add_argument('--seed', type=int, default=0, help='seed for the program generator')
+  arg_parser.add_argument('--repeat', type=int, default=3,
+                          help='number of times each phase is timed, keeping the fastest '
+                               '(default: 3)')
+  arg_parser.add_argument('--output',
+                          help='file to write JSON results to (default: standard output)')
+  arg_parser.add_argument('--programs-dir',
+                          help='directory in which to save the generated programs')
+  args = arg_parser.parse_args()
+
+  report = run_benchmarks(args.sizes, args.seed, args.repeat, args.programs_dir)
+  _report(report)
+  if args.output:
+    with open(args.output, 'w') as output:
+      json.dump(report, output, indent=2, sort_keys=True)
+  else:
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
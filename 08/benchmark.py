@@ -0,0 +1,373 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+from os import path
+
+import load_translator
+
+_ROOT = path.join(path.dirname(path.abspath(__file__)), os.pardir)
+
+'''Generates synthetic multi-file VM programs. Each file declares a number of functions, which use
+every memory segment, every arithmetic and comparison operation, and labels with the branches
+between them. Every function calls the next one, so that the call chain is as deep as there are
+functions, and Sys.init calls the first one. For the chapter 7 translator, which handles neither
+functions nor branching, the program is instead a flat sequence of push, pop and arithmetic
+commands split across files.'''
+class ProgramGenerator:
+  _OPERATIONS = ['add', 'sub', 'neg', 'eq', 'gt', 'lt', 'and', 'or', 'not']
+  _SEGMENT_SIZES = {
+    'static':  10,
+    'this':    6,
+    'that':    6,
+    'temp':    8,
+    'pointer': 2,
+  }
+  _FUNCTION_LENGTH = 60
+
+  def __init__(self, seed=0):
+    self._random = random.Random(seed)
+
+  '''Return a dictionary mapping file names to the lines of each file, for a program of about
+  command_count commands in total.'''
+  def generate(self, command_count, functions=True):
+    file_count = max(1, command_count // 2000)
+    if not functions:
+      return dict([('Class%d.vm' % i, self._flat_commands(command_count // file_count))
+                   for i in range(file_count)])
+
+    function_count = max(1, command_count // self._FUNCTION_LENGTH)
+    names = ['Class%d.f%d' % (i % file_count, i) for i in range(function_count)]
+    files = dict([('Class%d.vm' % i, []) for i in range(file_count)])
+    for i, name in enumerate(names):
+      callee = names[i + 1] if i + 1 < len(names) else None
+      files['%s.vm' % name.split('.')[0]].extend(self._function(name, callee))
+    files['Sys.vm'] = [
+      'function Sys.init 0',
+      'push constant 0',
+      'call %s 1' % names[0],
+      'pop temp 0',
+      'label HALT',
+      'goto HALT',
+    ]
+    return files
+
+  def _flat_commands(self, command_count):
+    lines = ['// Synthetic commands']
+    for _ in range(command_count):
+      lines.append(self._push_pop_or_operation(num_locals=0, num_args=0))
+    return lines
+
+  def _function(self, name, callee):
+    r = self._random
+    num_locals, num_args = r.randrange(5), 1
+    lines = ['', '// Synthetic function', 'function %s %d' % (name, num_locals)]
+    labels = 0
+    for i in range(self._FUNCTION_LENGTH - 4):
+      roll = r.random()
+      if roll < 0.05:
+        labels += 1
+        lines.append('label L%d' % labels)
+      elif roll < 0.1 and labels:
+        lines.append('%s L%d' % (r.choice(['goto', 'if-goto']), r.randint(1, labels)))
+      else:
+        lines.append('%-30s// Command %d' % (self._push_pop_or_operation(num_locals, num_args), i))
+    if callee:
+      lines.append('push constant %d' % r.randrange(100))
+      lines.append('call %s 1' % callee)
+    else:
+      lines.append('push constant 0')
+    lines.append('return')
+    return lines
+
+  def _push_pop_or_operation(self, num_locals, num_args):
+    r = self._random
+    roll = r.random()
+    if roll < 0.35:
+      return r.choice(self._OPERATIONS)
+    segments = dict(self._SEGMENT_SIZES)
+    if num_locals:
+      segments['local'] = num_locals
+    if num_args:
+      segments['argument'] = num_args
+    segment = r.choice(sorted(segments))
+    if roll < 0.6:
+      return 'push constant %d' % r.randrange(32768)
+    elif roll < 0.8:
+      return 'push %s %d' % (segment, r.randrange(segments[segment]))
+    else:
+      return 'pop %s %d' % (segment, r.randrange(segments[segment]))
+
+
+'''Adapts the chapter 7 translator, which handles push, pop and arithmetic commands only, to the
+phases timed by Benchmark.'''
+class Chapter7Translator:
+  NAME = '07'
+  FUNCTIONS = False
+
+  def __init__(self):
+    self._module = load_translator.load(path.join(_ROOT, '07'), 'vm_translator_07')
+
+  def translate(self, program_dir):
+    self._module.Translator(program_dir)
+    return program_dir + '.asm'
+
+  def parse(self, vm_files):
+    parsed = []
+    for vm_file in vm_files:
+      parser = self._module.Parser(vm_file)
+      commands = []
+      while parser.has_more_commands():
+        parser.advance()
+        if parser.command_type() == 'C_ARITHMETIC':
+          commands.append((parser.command(),))
+        else:
+          commands.append((parser.command(), parser.arg1(), parser.arg2()))
+      parser.close()
+      parsed.append((vm_file, commands))
+    return parsed
+
+  def emit(self, program_dir, parsed):
+    output = _Output()
+    class CapturingCodeWriter(self._module.CodeWriter):
+      def _determine_assembly_filename(self, vm_path):
+        return os.devnull
+
+      def _write(self, s):
+        output.write(s + '\n')
+
+    writer = CapturingCodeWriter(program_dir)
+    for vm_file, commands in parsed:
+      writer.set_vm_filename(vm_file)
+      for command in commands:
+        if len(command) == 1:
+          writer.write_arithmetic(command[0])
+        else:
+          writer.write_push_pop(*command)
+    writer.close()
+    return output
+
+
+'''Adapts the chapter 8 translator to the phases timed by Benchmark: lowering each file into its
+commands, as the translator does, and writing them with its CodeWriter.'''
+class Chapter8Translator:
+  NAME = '08'
+  FUNCTIONS = True
+
+  def __init__(self):
+    self._module = load_translator.vm_translator
+
+  def translate(self, program_dir):
+    self._module.Translator(program_dir)
+    return path.join(program_dir, path.basename(program_dir) + '.asm')
+
+  def parse(self, vm_files):
+    parsed = []
+    for vm_file in vm_files:
+      functions = self._module.lower_vm_file(vm_file).functions
+      parsed.append((vm_file, [command for function in functions for command in function.commands]))
+    return parsed
+
+  def emit(self, program_dir, parsed):
+    output = _Output()
+    class CapturingCodeWriter(self._module.CodeWriter):
+      def _open_output(self, vm_path):
+        return output
+
+    writer = CapturingCodeWriter(program_dir)
+    for vm_file, commands in parsed:
+      writer.set_vm_filename(vm_file)
+      for command in commands:
+        writer.write_command(command)
+    writer.close()
+    return output
+
+TRANSLATORS = [Chapter7Translator, Chapter8Translator]
+
+'''Collects the code a CodeWriter writes, so that writing it to a file can be timed separately.'''
+class _Output:
+  def __init__(self):
+    self.chunks = []
+
+  def write(self, s):
+    self.chunks.append(s)
+
+  def close(self):
+    pass
+
+
+'''Times a translator on a program: end to end, and by phase. Parsing reads every command of every
+file; emitting generates the code for them, kept in memory; and writing writes that code to a
+file. Each is timed at least repeat times, and until at least min_time seconds have been spent on
+it, and the fastest time kept, so that small programs are not judged on a run or two of a few
+milliseconds.'''
+class Benchmark:
+  def __init__(self, repeat=3, min_time=1.0):
+    self._repeat = repeat
+    self._min_time = min_time
+
+  def run(self, translator, program_dir):
+    vm_files = sorted([path.join(program_dir, f) for f in os.listdir(program_dir)
+                       if f.endswith('.vm')])
+    timings = {}
+    output_path = self._time(timings, 'end_to_end', lambda: translator.translate(program_dir))
+    parsed = self._time(timings, 'parse', lambda: translator.parse(vm_files))
+    output = self._time(timings, 'emit', lambda: translator.emit(program_dir, parsed))
+    self._time(timings, 'write', lambda: self._write(output, output_path + '.tmp'))
+    os.remove(output_path + '.tmp')
+
+    commands = sum([len(file_commands) for _, file_commands in parsed])
+    with open(output_path) as output:
+      assembly = output.read()
+    instructions = len([line for line in assembly.splitlines()
+                        if line.strip() and not line.lstrip().startswith(('(', '//'))])
+    return {
+      'translator': translator.NAME,
+      'files': len(vm_files),
+      'commands': commands,
+      'seconds': timings,
+      'commands_per_second': commands / timings['end_to_end'],
+      'output_bytes': len(assembly),
+      'instructions': instructions,
+    }
+
+  def _write(self, output, output_path):
+    with open(output_path, 'w') as output_file:
+      output_file.writelines(output.chunks)
+
+  def _time(self, timings, phase, f):
+    times = []
+    while len(times) < self._repeat or sum(times) < self._min_time:
+      start = time.time()
+      result = f()
+      times.append(time.time() - start)
+    timings[phase] = min(times)
+    return result
+
+
+def run_benchmarks(sizes, seed=0, repeat=3, min_time=1.0, programs_dir=None):
+  translators = [translator_class() for translator_class in TRANSLATORS]
+  work_dir = tempfile.mkdtemp(prefix='vm-benchmark-')
+  results = []
+  try:
+    for size in sizes:
+      for translator in translators:
+        name = 'Synthetic%s_%d' % (translator.NAME, size)
+        program_dir = path.join(programs_dir or work_dir, name)
+        if not path.isdir(program_dir):
+          os.makedirs(program_dir)
+        files = ProgramGenerator(seed).generate(size, translator.FUNCTIONS)
+        for name, lines in files.items():
+          with open(path.join(program_dir, name), 'w') as vm_file:
+            vm_file.write('\n'.join(lines) + '\n')
+        result = Benchmark(repeat, min_time).run(translator, program_dir)
+        result['size'] = size
+        results.append(result)
+  finally:
+    shutil.rmtree(work_dir)
+  return {
+    'benchmark': 'vm-translator',
+    'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    'python': platform.python_version(),
+    'seed': seed,
+    'repeat': repeat,
+    'min_time': min_time,
+    'results': results,
+  }
+
+'''Compare report with baseline, writing any regressions to standard error: a throughput lower
+than the baseline's by more than tolerance (a fraction), or any growth in the number of instructions
+written. Returns True if there are none. Results are matched by translator and program size, and
+only if both reports used the same seed. Throughput is only compared for programs the baseline took
+at least min_seconds to translate, as timings shorter than that vary too much from run to run.'''
+def check_regressions(report, baseline, tolerance, min_seconds=0.1):
+  if report['seed'] != baseline['seed']:
+    sys.stderr.write('Baseline was generated with seed %d, not %d\n' % (
+      baseline['seed'], report['seed']))
+    return False
+
+  expected = dict([((result['translator'], result['size']), result)
+                   for result in baseline['results']])
+  passed = True
+  for result in report['results']:
+    key = (result['translator'], result['size'])
+    if key not in expected:
+      sys.stderr.write('No baseline for translator %s with %d commands\n' % key)
+      continue
+    base = expected[key]
+    if (base['seconds']['end_to_end'] >= min_seconds and
+        result['commands_per_second'] < base['commands_per_second'] * (1 - tolerance)):
+      sys.stderr.write('REGRESSION: translator %s with %d commands: %d commands/s, '
+                       'baseline %d\n' % (key + (result['commands_per_second'],
+                                                  base['commands_per_second'])))
+      passed = False
+    if result['instructions'] > base['instructions']:
+      sys.stderr.write('REGRESSION: translator %s with %d commands: %d instructions, '
+                       'baseline %d\n' % (key + (result['instructions'], base['instructions'])))
+      passed = False
+  return passed
+
+def _report(report):
+  phases = ('parse', 'emit', 'write', 'end_to_end')
+  sys.stderr.write('%10s %8s %s %12s %12s %12s\n' % (
+    'translator', 'commands', ' '.join(['%11s' % phase for phase in phases]), 'commands/s', 'bytes',
+    'instructions'))
+  for result in report['results']:
+    sys.stderr.write('%10s %8d %s %12d %12d %12d\n' % (
+      result['translator'],
+      result['commands'],
+      ' '.join(['%10.4fs' % result['seconds'][phase] for phase in phases]),
+      result['commands_per_second'],
+      result['output_bytes'],
+      result['instructions'],
+    ))
+
+
+if __name__ == '__main__':
+  arg_parser = argparse.ArgumentParser(
+    description='Benchmark the VM translators of chapters 7 and 8 on synthetic programs.')
+  arg_parser.add_argument('--sizes', type=int, nargs='+', default=[2000, 20000, 100000],
+                          help='numbers of VM commands in the programs generated '
+                               '(default: 2000 20000 100000)')
+  arg_parser.add_argument('--seed', type=int, default=0, help='seed for the program generator')
+  arg_parser.add_argument('--repeat', type=int, default=3,
+                          help='least number of times each phase is timed, keeping the fastest '
+                               '(default: 3)')
+  arg_parser.add_argument('--min-time', type=float, default=1.0, metavar='SECONDS',
+                          help='least time spent timing each phase, repeating it as needed '
+                               '(default: 1)')
+  arg_parser.add_argument('--output',
+                          help='file to write JSON results to (default: standard output)')
+  arg_parser.add_argument('--programs-dir',
+                          help='directory in which to save the generated programs')
+  arg_parser.add_argument('--save-baseline', metavar='FILE', help='save the results as a baseline')
+  arg_parser.add_argument('--check', metavar='FILE',
+                          help='compare the results with a saved baseline, exiting with an error '
+                               'if throughput or generated code size has regressed')
+  arg_parser.add_argument('--tolerance', type=float, default=20.0, metavar='PERCENT',
+                          help='drop in throughput below the baseline tolerated by --check '
+                               '(default: 20)')
+  args = arg_parser.parse_args()
+
+  report = run_benchmarks(args.sizes, args.seed, args.repeat, args.min_time, args.programs_dir)
+  _report(report)
+  if args.output:
+    with open(args.output, 'w') as output:
+      json.dump(report, output, indent=2, sort_keys=True)
+  elif not args.save_baseline:
+    json.dump(report, sys.stdout, indent=2, sort_keys=True)
+    sys.stdout.write('\n')
+
+  if args.save_baseline:
+    with open(args.save_baseline, 'w') as baseline:
+      json.dump(report, baseline, indent=2, sort_keys=True)
+  if args.check:
+    with open(args.check) as baseline:
+      if not check_regressions(report, json.load(baseline), args.tolerance / 100):
+        sys.exit(1)
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+from os import path
+
+_DIRECTORY = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(_DIRECTORY, os.pardir, '05'))
+sys.path.insert(0, path.join(_DIRECTORY, os.pardir, '06'))
+import assembler
+from emulator import SCREEN, Emulator
+from load_translator import vm_translator
+
+_SAMPLES = path.join(_DIRECTORY, 'samples')
+
+'''The ways of translating and assembling a program that are checked, each with the options passed
+to Translator and whether the assembly is assembled in a single pass. Every mode is compared with
+the first.'''
+MODES = [
+  ('default',                    {}, False),
+  ('-O',                         {'optimize': True}, False),
+  ('-Os',                        {'optimize_size': True}, False),
+  ('-O -Os',                     {'optimize': True, 'optimize_size': True}, False),
+  ('--eliminate-dead-functions', {'eliminate_dead_functions': True}, False),
+  ('-j 1',                       {'jobs': 1}, False),
+  ('--inline 20',                {'inline_max_size': 20, 'inline_max_growth': 1.0}, False),
+  ('-O -Os --inline 20',         {'optimize': True, 'optimize_size': True, 'inline_max_size': 20,
+                                  'inline_max_growth': 1.0}, False),
+  ('--cache-top',                {'cache_top': True}, False),
+  ('--cache-top -Os',            {'cache_top': True, 'optimize_size': True}, False),
+  ('--cache-top --inline 20',    {'cache_top': True, 'inline_max_size': 20,
+                                  'inline_max_growth': 1.0}, False),
+  ('--single-pass',              {}, True),
+  ('-O --single-pass',           {'optimize': True}, True),
+]
+
+'''Translate the VM program at program_path (a file, or a directory of them) in each of modes, run
+each translation until it halts, and compare the state each leaves behind with that of the first.
+Returns a list of (mode, differences) for each mode, where differences lists the (what, expected,
+found) that differ, including any size the translator reported that differs from that of the
+assembled code; for the first mode, this is always empty. The program is copied to work_dir, once
+for each mode, so that its directory is left as it was.'''
+def check_program(program_path, work_dir, modes=MODES, max_steps=10000000):
+  name = path.splitext(path.basename(path.normpath(program_path)))[0]
+  results = []
+  expected = None
+  for i, (mode, options, single_pass) in enumerate(modes):
+    program_dir = path.join(work_dir, str(i), name)
+    if path.isdir(program_path):
+      shutil.copytree(program_path, program_dir)
+    else:
+      os.makedirs(program_dir)
+      shutil.copy(program_path, program_dir)
+    translator = vm_translator.Translator(program_dir, **options)
+    with open(path.join(program_dir, name + '.asm')) as assembly:
+      words, symbol_table, _ = assembler.assemble(assembly.read(), single_pass)
+    state = _run(words, symbol_table, max_steps)
+
+    if expected is None:
+      expected = state
+    results.append((mode, [(key, expected.get(key), state.get(key))
+                           for key in sorted(set(expected) | set(state))
+                           if expected.get(key) != state.get(key)] +
+                          _check_report(translator, words, symbol_table)))
+  return results
+
+'''Compare the sizes translator reported with those of the assembled code, words, with the labels
+in symbol_table, returning the (what, actual, reported) that differ.'''
+def _check_report(translator, words, symbol_table):
+  differences = []
+  if translator.optimizer and translator.optimizer.instructions_after != len(words):
+    differences.append(('instructions after peephole optimization', len(words),
+                        translator.optimizer.instructions_after))
+
+  if translator.rom_savings:
+    # The runtime routines run from the first of them to the first label not in them.
+    routines = vm_translator.CodeWriter._RUNTIME_ROUTINES.values()
+    routine_labels = set(routines + ['%s_END' % label for label in routines])
+    labels = symbol_table.labels()
+    start = labels[vm_translator.CodeWriter._RUNTIME_ROUTINES['call']]
+    end = min([address for label, address in labels.items()
+               if address > start and label not in routine_labels])
+    if end - start != -translator.rom_savings['routines']:
+      differences.append(('instructions in runtime routines', end - start,
+                          -translator.rom_savings['routines']))
+  return differences
+
+'''Run a program until it halts, returning the state it leaves behind that every translation must
+agree on: whether it halted within max_steps instructions, its static variables (by name, as their
+addresses depend on the order the assembler meets them), temp, THIS and THAT, and the heap from 2048
+on. The stack is not compared, as it holds return addresses and saved pointers, and inlining adds
+locals to frames, so programs checked should leave their results in static variables.'''
+def _run(words, symbol_table, max_steps):
+  emulator = Emulator(words)
+  emulator.run(max_steps)
+  if not emulator.halted:
+    return {'halted': False}
+
+  ram = emulator.ram[:SCREEN]
+  state = dict([('static %s' % symbol, ram[address])
+                for symbol, address in symbol_table.variables().items()])
+  state['halted'] = True
+  state.update([('temp %d' % i, ram[5 + i]) for i in range(8)])
+  state.update([('pointer 0', ram[3]), ('pointer 1', ram[4])])
+  state.update([('RAM[%d]' % address, value) for address, value in enumerate(ram[2048:], 2048)
+                if value])
+  return state
+
+def _sample_programs():
+  return [path.join(_SAMPLES, name) for name in sorted(os.listdir(_SAMPLES))
+          if path.isdir(path.join(_SAMPLES, name))]
+
+
+if __name__ == '__main__':
+  arg_parser = argparse.ArgumentParser(
+    description='Check that every mode of the VM translator and assembler computes the same '
+                'results, by running each translation of sample programs on the emulator.')
+  arg_parser.add_argument('paths', nargs='*', metavar='path',
+                          help='VM file, or directory containing VM files, to check '
+                               '(default: the programs in %s)' % _SAMPLES)
+  arg_parser.add_argument('--max-steps', type=int, default=10000000,
+                          help='instructions after which a program that has not halted fails '
+                               '(default: 10000000)')
+  args = arg_parser.parse_args()
+
+  work_dir = tempfile.mkdtemp(prefix='vm-equivalence-')
+  failures = 0
+  try:
+    for program_path in args.paths or _sample_programs():
+      results = check_program(program_path, tempfile.mkdtemp(dir=work_dir),
+                              max_steps=args.max_steps)
+      for mode, differences in results:
+        print '%-20s %-30s %s' % (path.basename(path.normpath(program_path)), mode,
+                                  differences and 'DIFFERS' or 'ok')
+        for what, expected, found in differences:
+          print '  %s: %s, expected %s' % (what, found, expected)
+        failures += bool(differences)
+  finally:
+    shutil.rmtree(work_dir)
+  sys.exit(1 if failures else 0)
@@ -0,0 +1,12 @@
+'''Loads the VM translator for the scripts in this directory. The translator's filename is not a
+valid module name, so it cannot simply be imported.'''
+import imp
+from os import path
+
+_DIRECTORY = path.dirname(path.abspath(__file__))
+
+'''Load the vm-translator.py in directory as a module called name.'''
+def load(directory, name):
+  return imp.load_source(name, path.join(directory, 'vm-translator.py'))
+
+vm_translator = load(_DIRECTORY, 'vm_translator')
@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+import argparse
+import json
+import os
+import signal
+import SocketServer
+import socket
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from collections import OrderedDict
+from os import path
+
+_DIRECTORY = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(_DIRECTORY, os.pardir, '06'))
+import assembler
+from load_translator import vm_translator
+
+_DEFAULT_SOCKET = path.join(tempfile.gettempdir(), 'hack-toolchain-%d.sock' % os.getuid())
+
+class JobError(Exception):
+  pass
+
+
+'''A least recently used cache of files as parsed, keyed by path. An entry is only returned while
+the file's modification time and size are unchanged. Safe to use from several threads.'''
+class ParsedFileCache:
+  def __init__(self, max_entries=256):
+    self._max_entries = max_entries
+    self._entries = OrderedDict()
+    self._lock = threading.Lock()
+    self.hits = 0
+    self.misses = 0
+
+  '''Return the parsed file at file_path, calling parse(file_path) if it is not cached or has
+  changed since it was.'''
+  def get(self, file_path, parse):
+    file_path = path.realpath(file_path)
+    stat = os.stat(file_path)
+    version = (stat.st_mtime, stat.st_size)
+    with self._lock:
+      entry = self._entries.pop(file_path, None)
+      if entry is not None and entry[0] == version:
+        self._entries[file_path] = entry
+        self.hits += 1
+        return entry[1]
+      self.misses += 1
+
+    # Parse outside the lock, so that jobs parsing other files are not held up.
+    parsed = parse(file_path)
+    with self._lock:
+      self._entries[file_path] = (version, parsed)
+      while len(self._entries) > self._max_entries:
+        self._entries.popitem(last=False)
+    return parsed
+
+  def stats(self):
+    with self._lock:
+      return {'entries': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+
+'''Locks for the files jobs write, keyed by resolved path, so that jobs writing the same file take
+turns rather than writing it at once. Safe to use from several threads.'''
+class OutputLocks:
+  def __init__(self):
+    self._locks = {}
+    self._lock = threading.Lock()
+
+  def get(self, file_path):
+    with self._lock:
+      return self._locks.setdefault(path.realpath(file_path), threading.Lock())
+
+
+'''Return the path of the temporary file that file_path is written to before being renamed over
+it. It is in the same directory, so that the rename replaces file_path in one step, and no reader
+ever sees it half written.'''
+def _temporary_path(file_path):
+  return '%s.%d.tmp' % (file_path, os.getpid())
+
+'''Write file_path in the given mode by calling write with the open file, holding its lock in
+output_locks, and writing to a temporary file renamed over it once complete.'''
+def _write_atomically(output_locks, file_path, mode, write):
+  temporary_path = _temporary_path(file_path)
+  with output_locks.get(file_path):
+    try:
+      with open(temporary_path, mode) as output:
+        write(output)
+      os.rename(temporary_path, file_path)
+    finally:
+      if path.exists(temporary_path):
+        os.remove(temporary_path)
+
+
+'''A CodeWriter that holds the lock for its assembly file from opening it until it is closed, and
+writes to a temporary file renamed over the assembly file once it is complete. If translation
+fails, discard() must be called instead of close().'''
+class AtomicCodeWriter(vm_translator.CodeWriter):
+  def __init__(self, output_locks, vm_path, *args):
+    self._output_locks = output_locks
+    self._output_lock = None
+    vm_translator.CodeWriter.__init__(self, vm_path, *args)
+
+  def _open_output(self, vm_path):
+    self.assembly_path = self._determine_assembly_path(vm_path)
+    self._output_lock = self._output_locks.get(self.assembly_path)
+    self._output_lock.acquire()
+    try:
+      return open(_temporary_path(self.assembly_path), 'w')
+    except Exception:
+      self._release()
+      raise
+
+  def close(self):
+    try:
+      vm_translator.CodeWriter.close(self)
+      os.rename(self._output.name, self.assembly_path)
+    finally:
+      self.discard()
+
+  '''Remove the temporary file, if it has not been renamed over the assembly file, and release the
+  lock. Does nothing once done.'''
+  def discard(self):
+    if self._output_lock is None:
+      return
+    try:
+      self._output.close()
+      if path.exists(self._output.name):
+        os.remove(self._output.name)
+    finally:
+      self._release()
+
+  def _release(self):
+    self._output_lock.release()
+    self._output_lock = None
+
+
+'''A Translator that takes the Files it lowers from a ParsedFileCache. The passes replace the
+functions of a File, and the commands of a Function, rather than changing them in place, so each
+translation is given its own copies of these, sharing the Commands.'''
+class CachingTranslator(vm_translator.Translator):
+  def __init__(self, files, output_locks, vm_path, **options):
+    self._files = files
+    self._output_locks = output_locks
+    self._code_writer = None
+    try:
+      vm_translator.Translator.__init__(self, vm_path,
+                                        code_writer_factory=self._create_code_writer, **options)
+    except Exception:
+      if self._code_writer is not None:
+        self._code_writer.discard()
+      raise
+    self.assembly_path = self._code_writer.assembly_path
+
+  def _lower_vm_file(self, file_path):
+    vm_file = self._files.get(file_path, vm_translator.lower_vm_file)
+    return vm_translator.File(file_path, [
+      vm_translator.Function(function.name, list(function.commands))
+      for function in vm_file.functions])
+
+  def _create_code_writer(self, vm_path, *args):
+    return AtomicCodeWriter(self._output_locks, vm_path, *args)
+
+
+'''Runs translate and assemble jobs, keeping the files each has parsed for the next. A job is a
+dictionary naming the job and the path to work on, with any options:
+
+  {"job": "translate", "path": "Fib", "options": {"optimize": true}}
+  {"job": "assemble", "path": "Fib/Fib.asm", "options": {"format": "bin"}}
+  {"job": "stats"}
+
+translate takes the options of Translator that do not involve other processes or the disk cache,
+and assemble takes the format and byte order of the output. Both write their output as the command
+line tools would, and return its path; jobs writing the same file take turns, and replace it only
+once they have written it in full. Each option is given with the types of value it accepts,
+and a description of them for errors.'''
+class Toolchain:
+  _FLAG = (bool, 'true or false')
+  _TRANSLATE_OPTIONS = {
+    'debug':                    _FLAG,
+    'optimize':                 _FLAG,
+    'optimize_size':            _FLAG,
+    'cache_top':                _FLAG,
+    'eliminate_dead_functions': _FLAG,
+    'inline_max_size':          ((int, long), 'an integer'),
+    'inline_max_growth':        ((int, long, float), 'a number'),
+  }
+  _ASSEMBLE_OPTIONS = {
+    'format':     (basestring, 'a string'),
+    'byte_order': (basestring, 'a string'),
+  }
+
+  def __init__(self, max_entries=256):
+    self._vm_files = ParsedFileCache(max_entries)
+    self._assembly_files = ParsedFileCache(max_entries)
+    self._output_locks = OutputLocks()
+    self._jobs = {
+      'translate': self._translate,
+      'assemble':  self._assemble,
+      'stats':     self._stats,
+    }
+    self._lock = threading.Lock()
+    self.jobs_run = 0
+
+  '''Run job, returning a reply: the job's results with 'ok' set to true, or 'ok' set to false and
+  an error message. Any 'id' in the job is returned in the reply. Jobs may be run from several
+  threads at once.'''
+  def run(self, job):
+    start = time.time()
+    try:
+      if not isinstance(job, dict) or job.get('job') not in self._jobs:
+        raise JobError('Unknown job: %s' % (job.get('job') if isinstance(job, dict) else job))
+      reply = self._jobs[job['job']](job.get('options') or {}, job)
+      reply['ok'] = True
+    except (JobError, vm_translator.ParseError, vm_translator.CodeWriteError, assembler.ParseError,
+            assembler.AssembleError, EnvironmentError, ValueError, KeyError, TypeError) as e:
+      reply = {'ok': False, 'error': '%s: %s' % (e.__class__.__name__, e)}
+    except Exception as e:
+      # Anything else is a bug: fail the job rather than the connection it came from, and log it.
+      traceback.print_exc()
+      reply = {'ok': False, 'error': 'Internal error: %s: %s' % (e.__class__.__name__, e)}
+    with self._lock:
+      self.jobs_run += 1
+    reply['seconds'] = time.time() - start
+    if isinstance(job, dict) and 'id' in job:
+      reply['id'] = job['id']
+    return reply
+
+  def _translate(self, options, job):
+    self._check_options(options, self._TRANSLATE_OPTIONS)
+    if options.get('cache_top') and options.get('optimize'):
+      raise JobError('cache_top cannot be combined with optimize')
+    translator = CachingTranslator(self._vm_files, self._output_locks, self._get_path(job),
+                                   **options)
+    return {'output': translator.assembly_path}
+
+  def _assemble(self, options, job):
+    self._check_options(options, self._ASSEMBLE_OPTIONS)
+    if options.get('format', 'text') == 'bin':
+      writer = assembler.BinaryWriter(options.get('byte_order', 'little'))
+    elif options.get('format', 'text') == 'text':
+      writer = assembler.TextWriter()
+    else:
+      raise JobError('Unknown format: %s' % options['format'])
+
+    filename = self._get_path(job)
+    commands = self._assembly_files.get(filename, self._parse_assembly_file)
+    words = assembler.Assembler().encode(commands, assembler.SymbolTableBuilder(commands).build())
+    assembled_filename = assembler._determine_assembled_filename(filename, writer.EXTENSION)
+    _write_atomically(self._output_locks, assembled_filename, writer.FILE_MODE,
+                      lambda assembled: writer.write(words, assembled))
+    return {'output': assembled_filename, 'instructions': len(words)}
+
+  def _parse_assembly_file(self, filename):
+    with open(filename) as source:
+      return list(assembler.Parser(source))
+
+  def _stats(self, options, job):
+    with self._lock:
+      jobs_run = self.jobs_run
+    return {'jobs': jobs_run, 'vm_files': self._vm_files.stats(),
+            'assembly_files': self._assembly_files.stats()}
+
+  def _get_path(self, job):
+    if not isinstance(job.get('path'), basestring):
+      raise JobError('No path given for %s job' % job['job'])
+    return job['path']
+
+  def _check_options(self, options, allowed):
+    if not isinstance(options, dict):
+      raise JobError('Options must be an object, not %s' % json.dumps(options))
+    unknown = set(options) - set(allowed)
+    if unknown:
+      raise JobError('Unknown options: %s' % ', '.join(sorted(unknown)))
+    for name, value in sorted(options.items()):
+      types, description = allowed[name]
+      # JSON's true and false are ints to isinstance, but are not accepted as numbers.
+      if not isinstance(value, types) or (isinstance(value, bool) and types is not bool):
+        raise JobError('Option %s must be %s, not %s' % (name, description, json.dumps(value)))
+
+
+'''Reads jobs from a connection, one JSON object per line, and writes a reply to each in the same
+form. Jobs on one connection are run in turn; each connection is served by its own thread.'''
+class JobHandler(SocketServer.StreamRequestHandler):
+  def handle(self):
+    for line in iter(self.rfile.readline, ''):
+      if not line.strip():
+        continue
+      try:
+        job = json.loads(line)
+      except ValueError as e:
+        reply = {'ok': False, 'error': 'Invalid job: %s' % e}
+      else:
+        reply = self.server.toolchain.run(job)
+      self.wfile.write(json.dumps(reply) + '\n')
+      self.wfile.flush()
+
+
+'''Serves a Toolchain over a Unix socket, keeping the translator, the assembler and the files they
+have parsed loaded between jobs.'''
+class ToolchainServer(SocketServer.ThreadingUnixStreamServer):
+  daemon_threads = True
+
+  def __init__(self, socket_path, toolchain):
+    self.toolchain = toolchain
+    # A socket left behind by a server that did not shut down cleanly would prevent binding.
+    if path.exists(socket_path):
+      os.remove(socket_path)
+    SocketServer.ThreadingUnixStreamServer.__init__(self, socket_path, JobHandler)
+
+  def server_close(self):
+    SocketServer.ThreadingUnixStreamServer.server_close(self)
+    if path.exists(self.server_address):
+      os.remove(self.server_address)
+
+
+'''Send job to the server listening at socket_path, and return its reply.'''
+def submit(job, socket_path=_DEFAULT_SOCKET):
+  connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    connection.connect(socket_path)
+    connection.sendall(json.dumps(job) + '\n')
+    return json.loads(connection.makefile().readline())
+  finally:
+    connection.close()
+
+
+if __name__ == '__main__':
+  arg_parser = argparse.ArgumentParser(
+    description='Keep the VM translator and assembler loaded in a server, and submit jobs to it.')
+  arg_parser.add_argument('--socket', default=_DEFAULT_SOCKET,
+                          help='path of the Unix socket the server listens on (default: %s)'
+                               % _DEFAULT_SOCKET)
+  subparsers = arg_parser.add_subparsers(dest='command')
+
+  serve_parser = subparsers.add_parser('serve', help='run the server until interrupted')
+  serve_parser.add_argument('--cache-entries', type=int, default=256,
+                            help='number of parsed files of each kind kept in memory '
+                                 '(default: 256)')
+
+  translate_parser = subparsers.add_parser('translate', help='translate VM code to assembly')
+  translate_parser.add_argument('path', help='VM file, or directory containing VM files')
+  translate_parser.add_argument('--debug', action='store_true',
+                                help='include VM commands as comments')
+  translate_parser.add_argument('-O', dest='optimize', action='store_true',
+                                help='enable peephole optimizations')
+  translate_parser.add_argument('-Os', dest='optimize_size', action='store_true',
+                                help='call shared runtime routines for commands that expand to '
+                                     'long sequences')
+  translate_parser.add_argument('--cache-top', action='store_true',
+                                help='keep the top of the stack in the D register between VM '
+                                     'commands (cannot be combined with -O)')
+  translate_parser.add_argument('--eliminate-dead-functions', action='store_true',
+                                help='omit functions that cannot be reached from Sys.init')
+  translate_parser.add_argument('--inline', type=int, metavar='MAX_SIZE',
+                                help='inline calls to functions of at most MAX_SIZE VM commands')
+  translate_parser.add_argument('--inline-growth', type=float, default=10.0, metavar='PERCENT',
+                                help='stop inlining once the program has grown by PERCENT%% of its '
+                                     'VM commands (default: 10)')
+
+  assemble_parser = subparsers.add_parser('assemble', help='assemble assembly to machine code')
+  assemble_parser.add_argument('path', help='assembly file to assemble')
+  assemble_parser.add_argument('--format', choices=('text', 'bin'), default='text',
+                               help='write a .hack text file (default), or a .bin image of raw '
+                                    '16-bit words')
+  assemble_parser.add_argument('--byte-order', choices=assembler.BinaryWriter.BYTE_ORDERS,
+                               default='little',
+                               help='byte order of words in a .bin image (default: little)')
+
+  subparsers.add_parser('stats', help='report the jobs run and the parsed files cached')
+  args = arg_parser.parse_args()
+
+  if args.command == 'serve':
+    server = ToolchainServer(args.socket, Toolchain(args.cache_entries))
+    # Remove the socket when terminated, as well as when interrupted.
+    signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+    try:
+      server.serve_forever()
+    except KeyboardInterrupt:
+      pass
+    finally:
+      server.server_close()
+    sys.exit(0)
+
+  job = {'job': args.command}
+  if args.command == 'translate':
+    job['path'] = path.abspath(args.path)
+    job['options'] = dict([(option, True) for option in ('debug', 'optimize', 'optimize_size',
+                                                          'cache_top', 'eliminate_dead_functions')
+                           if getattr(args, option)])
+    if args.inline:
+      job['options']['inline_max_size'] = args.inline
+      job['options']['inline_max_growth'] = args.inline_growth / 100
+  elif args.command == 'assemble':
+    job['path'] = path.abspath(args.path)
+    job['options'] = {'format': args.format, 'byte_order': args.byte_order}
+
+  reply = submit(job, args.socket)
+  if not reply.pop('ok'):
+    sys.stderr.write('%s\n' % reply['error'])
+    sys.exit(1)
+  json.dump(reply, sys.stdout, indent=2, sort_keys=True)
+  sys.stdout.write('\n')
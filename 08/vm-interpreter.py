@@ -0,0 +1,334 @@
+#!/usr/bin/env python
+import argparse
+import sys
+import time
+from os import path
+
+from load_translator import vm_translator
+ArithmeticAndLogicalOpsTable = vm_translator.ArithmeticAndLogicalOpsTable
+
+
+class VMError(Exception):
+  pass
+
+
+'''Wrap an integer to a signed 16-bit value, as the Hack ALU would.'''
+def _wrap(value):
+  return ((value + 0x8000) & 0xffff) - 0x8000
+
+_BINARY_OPERATIONS = {
+  '+': lambda x, y: _wrap(x + y),
+  '-': lambda x, y: _wrap(x - y),
+  '&': lambda x, y: x & y,
+  '|': lambda x, y: x | y,
+}
+
+_UNARY_OPERATIONS = {
+  '!': lambda x: ~x,
+  '-': lambda x: _wrap(-x),
+}
+
+# Comparisons are made on the difference of their operands, as in the translated code (which also
+# means they overflow as it does).
+_COMPARISONS = {
+  'JGT': lambda x, y: -(_wrap(x - y) > 0),
+  'JLT': lambda x, y: -(_wrap(x - y) < 0),
+  'JEQ': lambda x, y: -(x == y),
+}
+
+
+'''Runs VM programs directly, without translating them to Hack assembly. The program (a .vm file, or
+a directory of them) is lowered by the translator, with its files in the order it translates them,
+and decoded once into a flat list of operations, each a (handler, a, b) tuple: labels are resolved
+to indexes into the list, function names to the indexes of their entry points, and segment accesses
+to the addresses or pointers they use. Running it is then a matter of calling each handler in turn,
+which returns the index of the next operation.
+
+The memory layout matches that of translated programs: ram is a list of 32K words, with SP, LCL,
+ARG, THIS and THAT at 0-4, temp at 5-12, static variables from 16 (allocated in order of first use)
+and the stack from 256, so results can be checked against the same addresses. Return addresses on
+the stack are operation indexes rather than ROM addresses.
+
+As with the translated code, the program is started by calling Sys.init, if there is one, and
+otherwise from its first command with only SP set. It halts when it returns from Sys.init, runs off
+its end, or reaches a goto to itself (the usual way of ending a VM program).'''
+class VirtualMachine:
+  RAM_SIZE = 32768
+  _STACK_BASE = 256
+  _STATIC_BASE = 16
+  _STATIC_LIMIT = 256
+  _ENTRY_POINT = 'Sys.init'
+
+  # Addresses of the pointers to the dynamic segments, and of the fixed segments.
+  _SEGMENT_POINTERS = {
+    'local':    1,
+    'argument': 2,
+    'this':     3,
+    'that':     4,
+  }
+  _SEGMENT_ADDRESSES = {
+    'pointer': 3,
+    'temp':    5,
+  }
+
+  def __init__(self, path):
+    self.ram = [0] * self.RAM_SIZE
+    self._init_handlers()
+    self._decode(self._read_commands(vm_translator.lower_program(path)))
+    self.reset()
+
+  '''Return a list of (file name, command type, arguments) for every command in a Program.'''
+  def _read_commands(self, program):
+    commands = []
+    for vm_file in program.files:
+      name = path.splitext(path.basename(vm_file.path))[0]
+      for function in vm_file.functions:
+        commands.extend([(name, command.type, command.args) for command in function.commands])
+    return commands
+
+  def _decode(self, commands):
+    # Labels are scoped by function, as in the translator.
+    labels, functions = {}, {}
+    function = 'no_function'
+    index = 0
+    for _, command_type, args in commands:
+      if command_type == 'label':
+        labels['%s$%s' % (function, args[0])] = index
+        continue
+      if command_type == 'function':
+        function = args[0]
+        functions[function] = index
+      index += 1
+
+    self._statics = {}
+    self._code = []
+    function = 'no_function'
+    for name, command_type, args in commands:
+      if command_type == 'label':
+        continue
+      if command_type == 'function':
+        function = args[0]
+      self._code.append(self._decode_command(name, function, command_type, args, labels, functions))
+    self._entry_point = functions.get(self._ENTRY_POINT)
+
+  def _decode_command(self, name, function, command_type, args, labels, functions):
+    handlers = self._handlers
+    if command_type == 'arithmetic':
+      command = args[0]
+      for category in ArithmeticAndLogicalOpsTable.categories():
+        if command in ArithmeticAndLogicalOpsTable.ops_with_symbols(category):
+          symbol = ArithmeticAndLogicalOpsTable.symbol(category, command)
+          break
+      if category == 'unary_transformation':
+        return (handlers['unary'], _UNARY_OPERATIONS[symbol], None)
+      elif category == 'binary_transformation':
+        return (handlers['binary'], _BINARY_OPERATIONS[symbol], None)
+      else:
+        return (handlers['binary'], _COMPARISONS[symbol], None)
+    elif command_type in ('push', 'pop'):
+      return self._decode_push_pop(name, command_type, args[0], int(args[1]))
+    elif command_type in ('goto', 'if'):
+      label = '%s$%s' % (function, args[0])
+      if label not in labels:
+        raise VMError('Unknown label: %s' % args[0])
+      if command_type == 'goto' and labels[label] == len(self._code):
+        return (handlers['halt'], None, None)
+      return (handlers[command_type], labels[label], None)
+    elif command_type == 'call':
+      if args[0] not in functions:
+        raise VMError('Unknown function: %s' % args[0])
+      return (handlers['call'], functions[args[0]], int(args[1]))
+    elif command_type == 'function':
+      return (handlers['function'], int(args[1]), None)
+    else:
+      return (handlers['return'], None, None)
+
+  def _decode_push_pop(self, name, command_type, segment, index):
+    handlers = self._handlers
+    if segment == 'constant':
+      if command_type == 'pop':
+        raise VMError('Cannot pop into constant segment')
+      return (handlers['push_constant'], index, None)
+    elif segment in self._SEGMENT_POINTERS:
+      return (handlers['%s_indirect' % command_type], self._SEGMENT_POINTERS[segment], index)
+    elif segment in self._SEGMENT_ADDRESSES:
+      return (handlers['%s_address' % command_type], self._SEGMENT_ADDRESSES[segment] + index, None)
+    elif segment == 'static':
+      return (handlers['%s_address' % command_type], self._static_address(name, index), None)
+    else:
+      raise VMError('Unknown push/pop command: %s %s %s' % (command_type, segment, index))
+
+  def _static_address(self, name, index):
+    symbol = '%s.%s' % (name, index)
+    if symbol not in self._statics:
+      address = self._STATIC_BASE + len(self._statics)
+      if address >= self._STATIC_LIMIT:
+        raise VMError('Too many static variables: %s' % symbol)
+      self._statics[symbol] = address
+    return self._statics[symbol]
+
+  '''Return the addresses of the static variables, by name (e.g. "Main.0").'''
+  def statics(self):
+    return dict(self._statics)
+
+  '''The handlers of operations, each taking the index of the operation and its two operands, and
+  returning the index of the next operation.'''
+  def _init_handlers(self):
+    ram = self.ram
+
+    def push_constant(pc, value, _):
+      sp = ram[0]
+      ram[sp] = value
+      ram[0] = sp + 1
+      return pc + 1
+
+    def push_address(pc, address, _):
+      sp = ram[0]
+      ram[sp] = ram[address]
+      ram[0] = sp + 1
+      return pc + 1
+
+    def push_indirect(pc, pointer, offset):
+      sp = ram[0]
+      ram[sp] = ram[ram[pointer] + offset]
+      ram[0] = sp + 1
+      return pc + 1
+
+    def pop_address(pc, address, _):
+      sp = ram[0] - 1
+      ram[address] = ram[sp]
+      ram[0] = sp
+      return pc + 1
+
+    def pop_indirect(pc, pointer, offset):
+      sp = ram[0] - 1
+      ram[ram[pointer] + offset] = ram[sp]
+      ram[0] = sp
+      return pc + 1
+
+    def binary(pc, operation, _):
+      sp = ram[0] - 1
+      ram[sp - 1] = operation(ram[sp - 1], ram[sp])
+      ram[0] = sp
+      return pc + 1
+
+    def unary(pc, operation, _):
+      sp = ram[0] - 1
+      ram[sp] = operation(ram[sp])
+      return pc + 1
+
+    def goto(pc, target, _):
+      return target
+
+    def if_goto(pc, target, _):
+      sp = ram[0] - 1
+      ram[0] = sp
+      if ram[sp]:
+        return target
+      return pc + 1
+
+    def call(pc, target, num_args):
+      sp = ram[0]
+      ram[sp] = pc + 1
+      ram[sp + 1:sp + 5] = ram[1:5]
+      ram[2] = sp - num_args
+      ram[0] = ram[1] = sp + 5
+      return target
+
+    def function(pc, num_locals, _):
+      sp = ram[0]
+      ram[sp:sp + num_locals] = [0] * num_locals
+      ram[0] = sp + num_locals
+      return pc + 1
+
+    def return_(pc, _, __):
+      frame = ram[1]
+      return_address = ram[frame - 5]
+      argument = ram[2]
+      ram[argument] = ram[ram[0] - 1]
+      ram[0] = argument + 1
+      ram[1:5] = ram[frame - 4:frame]
+      return return_address
+
+    def halt(pc, _, __):
+      self.halted = True
+      return len(self._code)
+
+    self._handlers = {
+      'push_constant': push_constant,
+      'push_address':  push_address,
+      'push_indirect': push_indirect,
+      'pop_address':   pop_address,
+      'pop_indirect':  pop_indirect,
+      'binary':        binary,
+      'unary':         unary,
+      'goto':          goto,
+      'if':            if_goto,
+      'call':          call,
+      'function':      function,
+      'return':        return_,
+      'halt':          halt,
+    }
+
+  '''Clear RAM and start the program again, calling Sys.init if there is one.'''
+  def reset(self):
+    self.ram[:] = [0] * self.RAM_SIZE
+    self.ram[0] = self._STACK_BASE
+    self.halted = False
+    self.steps = 0
+    self._pc = 0
+    if self._entry_point is not None:
+      # Returning from Sys.init runs off the end of the program.
+      self._pc = self._handlers['call'](len(self._code) - 1, self._entry_point, 0)
+
+  '''Run the program until it halts, or for at most max_steps operations. Returns the number of
+  operations run.'''
+  def run(self, max_steps=None):
+    code = self._code
+    end = len(code)
+    pc = self._pc
+    steps = 0
+    limit = max_steps if max_steps is not None else -1
+    try:
+      while pc < end and steps != limit:
+        handler, a, b = code[pc]
+        pc = handler(pc, a, b)
+        steps += 1
+    except IndexError:
+      raise VMError('Stack or segment access out of range at operation %d' % pc)
+    if pc >= end:
+      self.halted = True
+    self._pc = pc
+    self.steps += steps
+    return steps
+
+
+'''Parse a RAM range argument of the form ADDRESS or FIRST-LAST.'''
+def _ram_range(argument):
+  first, _, last = argument.partition('-')
+  try:
+    return int(first), int(last or first)
+  except ValueError:
+    raise argparse.ArgumentTypeError('invalid RAM range: %s' % argument)
+
+
+if __name__ == '__main__':
+  arg_parser = argparse.ArgumentParser(description='Run VM code directly.')
+  arg_parser.add_argument('path', help='VM file, or directory containing VM files')
+  arg_parser.add_argument('--max-steps', type=int, default=None,
+                          help='stop after this many VM commands if the program has not halted')
+  arg_parser.add_argument('--ram', type=_ram_range, action='append', default=[],
+                          metavar='FIRST[-LAST]',
+                          help='print the contents of RAM at these addresses once stopped '
+                               '(may be repeated)')
+  args = arg_parser.parse_args()
+
+  vm = VirtualMachine(args.path)
+  start = time.time()
+  steps = vm.run(args.max_steps)
+  elapsed = time.time() - start
+  sys.stderr.write('%s after %d steps in %.3fs (%d steps/s)\n' % (
+    vm.halted and 'Halted' or 'Stopped', steps, elapsed, steps / max(elapsed, 1e-9)))
+  for first, last in args.ram:
+    for address in range(first, last + 1):
+      print 'RAM[%d] = %d' % (address, vm.ram[address])
@@ -0,0 +1,86 @@
+#!/usr/bin/env python
+import argparse
+import os
+import sys
+from os import path
+
+_DIRECTORY = path.dirname(path.abspath(__file__))
+sys.path.insert(0, path.join(_DIRECTORY, os.pardir, '06'))
+from assembler import Assembler, BinaryWriter, Parser, SymbolTableBuilder, TextWriter
+from load_translator import vm_translator
+
+'''A CodeWriter that hands each line it writes to the assembler as a Command record, rather than
+writing it to an assembly file (unless write_assembly is true, when it does both). CodeWriter only
+writes lines of text, so each is still parsed into a record; but the translator writes the same few
+instructions over and over, so each distinct line is parsed only once and its record shared.'''
+class AssemblingCodeWriter(vm_translator.CodeWriter):
+  def __init__(self, write_assembly, vm_path, *args):
+    self._write_assembly = write_assembly
+    self._parsed = {}
+    self.commands = []
+    self.assembly_path = self._determine_assembly_path(vm_path)
+    vm_translator.CodeWriter.__init__(self, vm_path, *args)
+
+  def _open_output(self, vm_path):
+    if self._write_assembly:
+      return vm_translator.CodeWriter._open_output(self, vm_path)
+    return open(os.devnull, 'w')
+
+  def _emit(self, line):
+    if line and not line.startswith('//'):
+      command = self._parsed.get(line)
+      if command is None:
+        command = self._parsed[line] = iter(Parser([line])).next()
+      self.commands.append(command)
+      # The line counter must still count instructions when they are not written.
+      if not self._write_assembly and command.type != 'L_COMMAND':
+        self._line_counter += 1
+
+    if self._write_assembly:
+      vm_translator.CodeWriter._emit(self, line)
+
+
+'''Return a factory for Translator's code_writer_factory argument, which appends the
+AssemblingCodeWriter it creates to code_writers.'''
+def _code_writer_factory(write_assembly, code_writers):
+  def create(*args):
+    code_writer = AssemblingCodeWriter(write_assembly, *args)
+    code_writers.append(code_writer)
+    return code_writer
+  return create
+
+def _assemble(code_writer):
+  commands = code_writer.commands
+  words = Assembler().encode(commands, SymbolTableBuilder(commands).build())
+  return words, code_writer.assembly_path
+
+def _determine_machine_code_path(assembly_path, extension):
+  return path.splitext(assembly_path)[0] + extension
+
+
+if __name__ == '__main__':
+  arg_parser = argparse.ArgumentParser(
+    description='Translate VM code into Hack machine code in one step, without writing assembly.')
+  arg_parser.add_argument('path', help='VM file, or directory containing VM files')
+  arg_parser.add_argument('--format', choices=('text', 'bin'), default='text',
+                          help='write a .hack text file (default), or a .bin image of raw '
+                               '16-bit words')
+  arg_parser.add_argument('--byte-order', choices=BinaryWriter.BYTE_ORDERS, default='little',
+                          help='byte order of words in a .bin image (default: little)')
+  arg_parser.add_argument('--asm', action='store_true',
+                          help='also write the assembly to a .asm file, for debugging')
+  vm_translator.add_arguments(arg_parser)
+  args = arg_parser.parse_args()
+
+  if args.format == 'bin':
+    writer = BinaryWriter(args.byte_order)
+  else:
+    writer = TextWriter()
+
+  code_writers = []
+  vm_translator.translate_from_arguments(args, arg_parser,
+                                         _code_writer_factory(args.asm, code_writers))
+  words, assembly_path = _assemble(code_writers[0])
+  with open(_determine_machine_code_path(assembly_path, writer.EXTENSION),
+            writer.FILE_MODE) as output:
+    writer.write(words, output)
@@ -1,51 +1,506 @@
 #!/usr/bin/env python
+import argparse
+import json
+import multiprocessing
 import os
 import re
 import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, '06'))
+from assembler import DiskCache
 
 class Translator:
-  def __init__(self, path):
-    self._init_command_args()
+  # passes is a list of passes run over the whole program, in order, once all VM files have been
+  # parsed and before any code is written. They run after the passes enabled by the other options.
+  #
+  # If eliminate_dead_functions is true, functions that cannot be reached from Sys.init are not
+  # written; dead_functions then lists them, with the number of instructions each would have taken.
+  #
+  # If inline_max_size is given, calls to functions of at most that many commands are replaced by
+  # the body of the function, as long as the program grows by no more than inline_max_growth (a
+  # fraction of its commands). Functions inlined at every call site are then dead.
+  #
+  # cache_top is passed on to CodeWriter.
+  #
+  # If jobs is given, the code for each file is written separately by a FragmentWriter, across jobs
+  # worker processes (or one per CPU, if jobs is 0), and the results are written in order of file
+  # path. The output then does not depend on the order in which files are listed or translated.
+  #
+  # If a FragmentCache is given as cache, the code for each file is written separately as if jobs
+  # were given (in a single process, if it is not), and taken from the cache if the file's commands
+  # and the options translating them are unchanged. fragments_reused then counts the files whose
+  # code was taken from the cache.
+  #
+  # code_writer_factory, if given, is called in place of CodeWriter to create the code writer, with
+  # the same arguments.
+  def __init__(self, path, debug=False, optimize=False, optimize_size=False, passes=[],
+               eliminate_dead_functions=False, inline_max_size=None, inline_max_growth=0.1,
+               cache_top=False, jobs=None, cache=None, code_writer_factory=None):
     # Find vm_files before initializing code writer in case the former process raises an exception.
-    vm_files = self._get_vm_file_paths(path)
-    self._code_writer = CodeWriter(path)
-
-    for vm_file in vm_files:
-      self._process_vm_file(vm_file)
+    vm_files = find_vm_files(path)
+    self.program = Program([self._lower_vm_file(vm_file) for vm_file in vm_files])
+    self.inliner = Inliner(inline_max_size, inline_max_growth) if inline_max_size else None
+    dead_function_eliminator = DeadFunctionEliminator() if eliminate_dead_functions else None
+    self.pass_manager = PassManager([p for p in [self.inliner, dead_function_eliminator] if p] +
+                                    passes)
+    self.pass_manager.run(self.program)
+
+    self.optimizer = PeepholeOptimizer() if optimize else None
+    self._code_writer = (code_writer_factory or CodeWriter)(path, debug, self.optimizer,
+                                                            optimize_size, cache_top)
+    self.dead_functions = None
+    if dead_function_eliminator:
+      count_instructions = self._code_writer.count_instructions
+      self.dead_functions = [(function.name, count_instructions(vm_file.path, function.commands))
+                             for vm_file, function in dead_function_eliminator.removed]
+    self.fragments_reused = 0
+    if jobs is None and cache is None:
+      for vm_file in self.program.files:
+        self._write_vm_file(vm_file)
+    else:
+      options = {'debug': debug, 'optimize': optimize, 'optimize_size': optimize_size,
+                 'cache_top': cache_top}
+      self._write_fragments(jobs if jobs is not None else 1, options, cache)
     self._code_writer.close()
-
-  def _init_command_args(self):
-    self._COMMAND_ARGS = {
-      'arithmetic': lambda parser: (parser.command(),),
-      'return':     lambda parser: tuple()
-    }
-    for command in ('push', 'pop', 'call', 'function'):
-      self._COMMAND_ARGS[command] = lambda parser: (parser.arg1(), parser.arg2())
-    for command in ('label', 'goto', 'if'):
-      self._COMMAND_ARGS[command] = lambda parser: (parser.arg1(),)
-
-  def _get_vm_file_paths(self, path):
-    if os.path.isdir(path):
-      vm_files = [os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith('.vm')]
-      if len(vm_files) == 0:
-        raise IOError('No .vm files in directory %s' % path)
-    elif os.path.isfile(path):
-      vm_files = [path]
+    self.rom_savings = self._code_writer.rom_savings() if optimize_size else None
+    self.code_sizes = self._code_writer.code_sizes
+
+  # Subclasses may override this to take the Files from elsewhere, such as a cache.
+  def _lower_vm_file(self, file_path):
+    return lower_vm_file(file_path)
+
+  def _write_fragments(self, jobs, options, cache):
+    vm_files = sorted(self.program.files, key=lambda vm_file: vm_file.path)
+    results = [None] * len(vm_files)
+    keys = [None] * len(vm_files)
+    if cache is not None:
+      for i, vm_file in enumerate(vm_files):
+        keys[i] = cache.key(vm_file, options)
+        results[i] = cache.get(keys[i])
+      self.fragments_reused = len([result for result in results if result is not None])
+
+    tasks = [(vm_file, options) for vm_file, result in zip(vm_files, results) if result is None]
+    if jobs == 1 or len(tasks) <= 1:
+      written = [_write_fragment(task) for task in tasks]
     else:
-      raise IOError('%s is not a file or directory' % path)
-
-    return vm_files
-
-  def _process_vm_file(self, file_path):
-    parser = Parser(file_path)
-    self._code_writer.set_vm_filename(file_path)
-
+      pool = multiprocessing.Pool(jobs or None)
+      try:
+        written = pool.map(_write_fragment, tasks)
+      finally:
+        pool.close()
+        pool.join()
+
+    written = iter(written)
+    for i, result in enumerate(results):
+      if result is None:
+        results[i] = written.next()
+        if cache is not None:
+          cache.put(keys[i], results[i])
+
+    for lines, stub_counts, comparisons_from_d, optimized, code_sizes in results:
+      self._code_writer.write_fragment(lines, stub_counts, comparisons_from_d, code_sizes)
+      if optimized:
+        self.optimizer.instructions_before += optimized[0]
+        self.optimizer.instructions_after += optimized[1]
+
+  def _write_vm_file(self, vm_file):
+    self._code_writer.set_vm_filename(vm_file.path)
+    for function in vm_file.functions:
+      for command in function.commands:
+        self._code_writer.write_command(command)
+
+
+'''A DiskCache of the code written for VM files by FragmentWriter, keyed by a hash of the file's
+commands and the options translating them, so that only the files that have changed need be
+translated again. As the labels a FragmentWriter generates are named after the file and numbered
+within it, the code for a file does not depend on the other files. Each entry is the (lines,
+stub_counts, comparisons_from_d, optimized, code_sizes) returned by _write_fragment.'''
+class FragmentCache(DiskCache):
+  _VERSION = 5
+  _ENTRY_EXTENSION = '.fragment'
+
+  # The file's commands are hashed after any whole-program passes have run, as these may change
+  # them (by inlining functions from other files, for instance). Its name is included, as static
+  # variables and labels are named after it.
+  def key(self, vm_file, options):
+    return self._digest([sorted(options.items()), os.path.basename(vm_file.path)],
+                        [command.text + '\n'
+                         for function in vm_file.functions for command in function.commands])
+
+
+'''Write the code for a VM file with a FragmentWriter, returning its lines, the number of runtime
+routine stubs it wrote (and of those for comparisons, how many were written while D held the top of
+the stack), the number of instructions before and after peephole optimization (or None, if not
+optimizing), and the sizes of its code by function and kind of command.'''
+def _write_fragment(task):
+  vm_file, options = task
+  optimizer = PeepholeOptimizer() if options['optimize'] else None
+  writer = FragmentWriter(vm_file.path, options['debug'], optimizer, options['optimize_size'],
+                          options['cache_top'])
+  for function in vm_file.functions:
+    for command in function.commands:
+      writer.write_command(command)
+  writer.close()
+  optimized = (optimizer.instructions_before, optimizer.instructions_after) if optimizer else None
+  return (writer.lines, writer.stub_counts(), writer.comparisons_from_d(), optimized,
+          writer.code_sizes)
+
+
+'''A VM command, as parsed: its type (as returned by Parser.command_type), the normalized text of
+the command, and the tuple of arguments passed to the CodeWriter method writing it.'''
+class Command(object):
+  __slots__ = ('type', 'text', 'args')
+
+  def __init__(self, type, text, args):
+    self.type = type
+    self.text = text
+    self.args = args
+
+  def __repr__(self):
+    return 'Command(%r)' % self.text
+
+
+'''The commands of a VM function, starting with its function command. The name of the function is
+None for commands preceding the first function declaration in a file.'''
+class Function(object):
+  __slots__ = ('name', 'commands')
+
+  def __init__(self, name, commands=None):
+    self.name = name
+    self.commands = commands if commands is not None else []
+
+  def __repr__(self):
+    return 'Function(%r, %d commands)' % (self.name, len(self.commands))
+
+
+'''The functions of a VM file, in the order they were declared. Static variables are named after the
+file, so functions keep the file they were declared in.'''
+class File(object):
+  __slots__ = ('path', 'functions')
+
+  def __init__(self, path, functions=None):
+    self.path = path
+    self.functions = functions if functions is not None else []
+
+  def add_function(self, function):
+    # The unnamed function is only kept if commands preceded the first function declaration.
+    if function.name is not None or function.commands:
+      self.functions.append(function)
+
+  def __repr__(self):
+    return 'File(%r, %d functions)' % (self.path, len(self.functions))
+
+
+'''The files of a VM program, in the order they are translated.'''
+class Program(object):
+  __slots__ = ('files',)
+
+  def __init__(self, files):
+    self.files = files
+
+  '''Return the (file, function) pairs of every function in the program.'''
+  def functions(self):
+    return [(vm_file, function) for vm_file in self.files for function in vm_file.functions]
+
+
+'''Return the paths of the VM files making up the program at path: the file itself, or the .vm files
+in the directory, in the order they are translated.'''
+def find_vm_files(path):
+  if os.path.isdir(path):
+    vm_files = [os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith('.vm')]
+    if len(vm_files) == 0:
+      raise IOError('No .vm files in directory %s' % path)
+  elif os.path.isfile(path):
+    vm_files = [path]
+  else:
+    raise IOError('%s is not a file or directory' % path)
+
+  return vm_files
+
+# The arguments of each type of command, read from a Parser positioned at it.
+_COMMAND_ARGS = {
+  'arithmetic': lambda parser: (parser.command(),),
+  'return':     lambda parser: tuple()
+}
+for command in ('push', 'pop', 'call', 'function'):
+  _COMMAND_ARGS[command] = lambda parser: (parser.arg1(), parser.arg2())
+for command in ('label', 'goto', 'if'):
+  _COMMAND_ARGS[command] = lambda parser: (parser.arg1(),)
+
+'''Parse a VM file into a File of Functions. Commands preceding the first function declaration are
+collected in a Function with no name.'''
+def lower_vm_file(file_path):
+  vm_file = File(file_path)
+  function = Function(None)
+  parser = Parser(file_path)
+  try:
     while parser.has_more_commands():
       parser.advance()
-      args = self._COMMAND_ARGS[parser.command_type()](parser)
-      command_writer = getattr(self._code_writer, 'write_%s' % parser.command_type())
-      command_writer(parser.command_with_args(), *args)
+      command = Command(parser.command_type(), parser.command_with_args(),
+                        _COMMAND_ARGS[parser.command_type()](parser))
+      if command.type == 'function':
+        vm_file.add_function(function)
+        function = Function(command.args[0])
+      function.commands.append(command)
+  finally:
     parser.close()
+  vm_file.add_function(function)
+  return vm_file
+
+'''Parse the VM file, or directory of VM files, at path into a Program, as Translator does before
+running any passes.'''
+def lower_program(path):
+  return Program([lower_vm_file(vm_file) for vm_file in find_vm_files(path)])
+
+
+'''The functions each function of a Program calls, by name. Commands preceding the first function
+declaration in a file are treated as a caller named None.'''
+class CallGraph:
+  def __init__(self, program):
+    self._callees = {}
+    for _, function in program.functions():
+      callees = self._callees.setdefault(function.name, set())
+      for command in function.commands:
+        if command.type == 'call':
+          callees.add(command.args[0])
+
+  def callees(self, name):
+    return self._callees.get(name, set())
+
+  '''Return the set of the names of the functions reachable from roots, including the roots.'''
+  def reachable_from(self, roots):
+    reachable = set()
+    pending = list(roots)
+    while pending:
+      name = pending.pop()
+      if name not in reachable:
+        reachable.add(name)
+        pending.extend(self.callees(name))
+    return reachable
+
+
+'''Replaces calls to small functions with a copy of the function's body, rewritten to run in the
+frame of the calling function. The arguments and locals of the called function are kept in locals
+added to the calling function, and their accesses are renumbered accordingly; the labels of each
+copy are renamed to keep them unique; and returns jump to the end of the copy, leaving the return
+value on the stack as a call would. The THIS and THAT pointers are saved and restored around the
+copy if the called function sets them, as a return restores them.
+
+Only functions of at most max_size commands (besides the function command) are inlined, and only if
+their stack use can be shown to be balanced: every return must leave exactly one value on the
+function's own working stack. Functions using static variables are only inlined into functions of
+the same file, as static variables are named after the file. Calls within an inlined body are left
+as calls. Inlining stops once the number of commands in the program has grown by max_growth (a
+fraction of the commands it started with).
+
+inlined counts the calls inlined, by name of the function called.'''
+class Inliner:
+  def __init__(self, max_size, max_growth=0.1):
+    self._max_size = max_size
+    self._max_growth = max_growth
+    self.inlined = {}
+
+  def run(self, program):
+    functions = dict([(function.name, (vm_file, function))
+                      for vm_file, function in program.functions() if function.name is not None])
+    candidates = {}
+    for name, (vm_file, function) in functions.items():
+      usage = self._analyse(function)
+      # Inlined bodies are copied from the functions as they were before any inlining into them.
+      if usage is not None:
+        candidates[name] = (vm_file, function.commands, usage)
+
+    budget = int(self._max_growth * sum([len(function.commands)
+                                         for _, function in program.functions()]))
+    for vm_file, function in program.functions():
+      # Commands outside a function have no frame to hold the locals of inlined functions.
+      if function.name is None:
+        continue
+      num_locals = int(function.commands[0].args[1])
+      frame_size = 0
+      # Labels are scoped by function, so copies need only be numbered within the calling function,
+      # which keeps the code for a function unaffected by inlining elsewhere.
+      self._copies = 0
+      commands = [function.commands[0]]
+      for command in function.commands[1:]:
+        if command.type == 'call' and command.args[0] in candidates:
+          callee_file, callee_commands, usage = candidates[command.args[0]]
+          num_args = int(command.args[1])
+          size = (len(callee_commands) - 1 + num_args + 2 * usage['locals'] +
+                  4 * len(usage['pointers']))
+          if (usage['max_argument'] < num_args and (callee_file is vm_file or not usage['static'])
+              and size - 1 <= budget):
+            budget -= max(size - 1, 0)
+            frame_size = max(frame_size, num_args + usage['locals'] + len(usage['pointers']))
+            commands.extend(self._copy(callee_commands, usage, num_args, num_locals))
+            self.inlined[command.args[0]] = self.inlined.get(command.args[0], 0) + 1
+            continue
+        commands.append(command)
+
+      if frame_size:
+        commands[0] = _make_command('function', function.name, num_locals + frame_size)
+      function.commands = commands
+
+  '''Return what a function uses of its frame (the number of locals, the highest argument index read
+  or written, the pointers set and whether it uses static variables), or None if it cannot be
+  inlined.'''
+  def _analyse(self, function):
+    body = function.commands[1:]
+    if function.name is None or len(body) > self._max_size:
+      return None
+
+    usage = {'locals': int(function.commands[0].args[1]), 'max_argument': -1, 'pointers': set(),
+             'static': False}
+    # Depth of the function's working stack before each command, or None after a goto or return
+    # (until the next label), and the depth at each label, as found at the label or a jump to it.
+    depth = 0
+    label_depths = {}
+    for command in body:
+      if command.type == 'label':
+        label = command.args[0]
+        if depth is None:
+          depth = label_depths.get(label)
+          if depth is None:
+            return None
+        elif label_depths.setdefault(label, depth) != depth:
+          return None
+        continue
+      if depth is None:
+        # Unreachable
+        continue
+
+      if command.type in ('push', 'pop'):
+        segment, index = command.args
+        if segment == 'argument':
+          usage['max_argument'] = max(usage['max_argument'], int(index))
+        elif segment == 'static':
+          usage['static'] = True
+        elif segment == 'pointer' and command.type == 'pop':
+          usage['pointers'].add(int(index))
+        depth += 1 if command.type == 'push' else -1
+      elif command.type == 'arithmetic':
+        unary_ops = ArithmeticAndLogicalOpsTable.ops_with_symbols('unary_transformation')
+        if command.args[0] not in unary_ops:
+          depth -= 1
+      elif command.type in ('goto', 'if'):
+        if command.type == 'if':
+          depth -= 1
+        if label_depths.setdefault(command.args[0], depth) != depth:
+          return None
+        if command.type == 'goto':
+          depth = None
+      elif command.type == 'call':
+        depth += 1 - int(command.args[1])
+      elif command.type == 'return':
+        if depth != 1:
+          return None
+        depth = None
+      else:
+        return None
+
+      if depth is not None and depth < 0:
+        return None
+
+    declared = set([command.args[0] for command in body if command.type == 'label'])
+    # A function must not run off its end, and jumps must be to labels in the function.
+    if depth is not None or not declared.issuperset(label_depths):
+      return None
+    return usage
+
+  '''Return the commands of a copy of the body of a function, given its commands, called with
+  num_args arguments from a function with num_locals locals.'''
+  def _copy(self, function_commands, usage, num_args, num_locals):
+    self._copies += 1
+    end_label = '__inline%d' % self._copies
+    rename_label = lambda label: '%s.%s' % (end_label, label)
+    arguments_base = num_locals
+    locals_base = arguments_base + num_args
+    pointers = dict([(pointer, locals_base + usage['locals'] + i)
+                     for i, pointer in enumerate(sorted(usage['pointers']))])
+
+    commands = []
+    for i in reversed(range(num_args)):
+      commands.append(_make_command('pop', 'local', arguments_base + i))
+    for i in range(usage['locals']):
+      commands.append(_make_command('push', 'constant', 0))
+      commands.append(_make_command('pop', 'local', locals_base + i))
+    for pointer, local in sorted(pointers.items()):
+      commands.append(_make_command('push', 'pointer', pointer))
+      commands.append(_make_command('pop', 'local', local))
+
+    body = function_commands[1:]
+    returns = 0
+    for i, command in enumerate(body):
+      if command.type in ('push', 'pop') and command.args[0] in ('argument', 'local'):
+        segment, index = command.args
+        base = arguments_base if segment == 'argument' else locals_base
+        command = _make_command(command.type, 'local', base + int(index))
+      elif command.type in ('label', 'goto', 'if'):
+        command = _make_command(command.type, rename_label(command.args[0]))
+      elif command.type == 'return':
+        # The last return falls through to the end of the copy.
+        if i == len(body) - 1:
+          continue
+        returns += 1
+        command = _make_command('goto', end_label)
+      commands.append(command)
+
+    if returns:
+      commands.append(_make_command('label', end_label))
+    for pointer, local in sorted(pointers.items()):
+      commands.append(_make_command('push', 'local', local))
+      commands.append(_make_command('pop', 'pointer', pointer))
+    return commands
+
+
+'''Return a Command of the given type (as returned by Parser.command_type) with the given
+arguments.'''
+def _make_command(type, *args):
+  args = tuple([str(arg) for arg in args])
+  if type == 'arithmetic':
+    return Command(type, args[0], args)
+  name = 'if-goto' if type == 'if' else type
+  return Command(type, ' '.join((name,) + args), args)
+
+
+'''Removes the functions that cannot be reached from Sys.init, which the bootstrap code calls, nor
+from any commands outside a function. The removed (file, function) pairs are listed in removed. If
+the program has no Sys.init, nothing is removed.'''
+class DeadFunctionEliminator:
+  _ENTRY_POINT = 'Sys.init'
+
+  def __init__(self):
+    self.removed = []
+
+  def run(self, program):
+    names = set([function.name for _, function in program.functions()])
+    if self._ENTRY_POINT not in names:
+      return
+    reachable = CallGraph(program).reachable_from([self._ENTRY_POINT, None])
+    for vm_file in program.files:
+      self.removed.extend([(vm_file, function) for function in vm_file.functions
+                           if function.name not in reachable])
+      vm_file.functions = [function for function in vm_file.functions if function.name in reachable]
+
+
+'''Runs a list of passes over a Program, in order. A pass is any object with a run(program) method,
+which may analyse the program or rewrite it in place; passes run later see the program as left by
+earlier ones. The time taken by each pass is recorded in timings.'''
+class PassManager:
+  def __init__(self, passes=[]):
+    self._passes = list(passes)
+    self.timings = []
+
+  def add(self, ir_pass):
+    self._passes.append(ir_pass)
+
+  def run(self, program):
+    for ir_pass in self._passes:
+      start = time.time()
+      ir_pass.run(program)
+      self.timings.append((ir_pass.__class__.__name__, time.time() - start))
+    return program
 
 
 class ParseError(Exception):
@@ -64,7 +519,8 @@ class Parser:
     self._read_next_command()
 
   def _init_types(self):
-    self._types = { 'if-goto':  'if' } # Special case -- method name "write_if-goto" not valid in Python.
+    # Special case -- method name "write_if-goto" not valid in Python.
+    self._types = { 'if-goto':  'if' }
     for type in ('push', 'pop', 'label', 'goto', 'function', 'return', 'call'):
       self._types[type] = type
     for arithmetic in ArithmeticAndLogicalOpsTable.all_ops():
@@ -107,7 +563,8 @@ class Parser:
     return self._command
 
   def command_with_args(self):
-    '''Return normalized command (that is, excess whitespace stripped from between args), with any args present.'''
+    '''Return normalized command (that is, excess whitespace stripped from between args), with any
+    args present.'''
     return ' '.join([str(e) for e in self._command, self._arg1, self._arg2 if e])
 
   def arg1(self):
@@ -183,12 +640,77 @@ class CodeWriter:
 
   _VM_EXTENSION_REGEX = re.compile(r'\.vm$', re.IGNORECASE)
 
-  def __init__(self, vm_path):
+  # Addresses of the fixed segments, for top-of-stack caching, which cannot compute them in D.
+  _FIXED_SEGMENT_ADDRESSES = {
+    'temp':    5,
+    'pointer': 3,
+  }
+
+  # Largest index of a dynamic segment popped into by stepping A from the segment base, when caching
+  # the top of the stack; larger indexes need the address computed through temporary variables.
+  _MAX_ADDRESS_STEPS = 7
+
+  # Number of lines buffered in memory before being written to the output file.
+  _BUFFER_LINES = 8192
+
+  # Labels of the runtime routines used when optimizing for size, by the kind of stub jumping to
+  # them.
+  _RUNTIME_ROUTINES = {
+    'call':   '__vm_call',
+    'return': '__vm_return',
+    'JGT':    '__vm_compare_JGT',
+    'JLT':    '__vm_compare_JLT',
+    'JEQ':    '__vm_compare_JEQ',
+  }
+
+  # In debug mode, each VM command is preceded by a comment listing it and followed by a blank line,
+  # and each instruction is annotated with its ROM address. Otherwise, only the instructions are
+  # written.
+  #
+  # If an optimizer is given, instructions are held back until the end of each basic block (that is,
+  # until the next label) and rewritten by the optimizer before being written.
+  #
+  # If optimize_size is true, calls, returns and comparisons are each emitted once as a runtime
+  # routine, with each use reduced to a stub that jumps to the routine.
+  #
+  # If cache_top is true, the top of the stack is kept in the D register rather than in memory
+  # across straight-line sequences of push, pop and arithmetic commands, and only written to memory
+  # before labels, jumps, calls and returns. As D is then live across commands (and across the
+  # labels within comparisons), this cannot be combined with the optimizer.
+  def __init__(self, vm_path, debug=False, optimizer=None, optimize_size=False, cache_top=False):
+    self._init_state(debug, optimizer, optimize_size, cache_top)
+    self._output = self._open_output(vm_path)
+    self.write_init()
+
+  def _init_state(self, debug, optimizer, optimize_size, cache_top):
+    if optimizer is not None and cache_top:
+      raise CodeWriteError('Top-of-stack caching cannot be combined with the peephole optimizer')
     self._unique_id = 0
+    # Prefix of the unique IDs in generated labels, if any.
+    self._namespace = None
     self._line_counter = 0
     self._current_function = 'no_function'
-    self._output = open(self._determine_assembly_path(vm_path), 'w')
-    self.write_init()
+    self._debug = debug
+    self._optimizer = optimizer
+    self._optimize_size = optimize_size
+    self._cache_top = cache_top
+    # True while D holds the top of the stack, which is then not in memory (SP points to it).
+    self._top_in_d = False
+    # Number of comparison stubs written while D held the top of the stack, by kind.
+    self._comparisons_from_d = dict([(jump_type, 0) for jump_type in ('JGT', 'JLT', 'JEQ')])
+    # Number of instructions written (before any optimization), in total and by (VM file name,
+    # function, kind of command); the bootstrap code and runtime routines have no file or function.
+    self._instructions_written = 0
+    self.code_sizes = {}
+    # Number of stubs written for each kind of runtime routine, and the instructions in the
+    # routines.
+    self._stub_counts = dict([(kind, 0) for kind in self._RUNTIME_ROUTINES])
+    self._runtime_length = 0
+    self._block = []
+    self._buffer = []
+
+  def _open_output(self, vm_path):
+    return open(self._determine_assembly_path(vm_path), 'w')
 
   # Place assembly file in same directory as VM files, regardless of whether input argument is a
   # directory or a VM file.
@@ -221,12 +743,18 @@ class CodeWriter:
     self._vm_basename = self._VM_EXTENSION_REGEX.sub('', vm_file_path)
 
   def _command(f):
-    '''Write comment listing command, as well as blank line separator.'''
+    '''Write comment listing command, as well as blank line separator, if in debug mode.'''
     def wrapped(self, *args, **kwargs):
-      comment = args[0]
-      self._write_comment(comment)
+      if self._debug:
+        comment = args[0]
+        self._write_comment(comment)
       f(self, *args[1:], **kwargs)
-      self._write_newline()
+      if self._debug:
+        self._write_newline()
+      # Bound the memory used by long blocks, ending them only between commands, as the optimizer
+      # assumes no register is live at the end of a block.
+      if len(self._block) >= self._BUFFER_LINES:
+        self._end_block()
     return wrapped
 
   @_command
@@ -241,12 +769,166 @@ class CodeWriter:
   # BUG: VM files must include a Sys.init function, or test scripts will fail. I should test for
   # existence of Sys.init function and call it only if present, but I don't.
   def write_init(self):
+    written = self._instructions_written
     self._init_stack_pointer('Initialize stack pointer')
     init_function = 'Sys.init'
     self.write_call('call %s' % init_function, init_function, 0)
+    self._record_size(None, None, 'bootstrap', written)
+    # Sys.init never returns, so the runtime routines can follow the call to it.
+    if self._optimize_size:
+      # The routines are measured as emitted, so the optimizer must not be holding any of them (or
+      # of the code before them) in its block.
+      if self._optimizer is not None:
+        self._end_block()
+      start, written = self._line_counter, self._instructions_written
+      self._write_runtime_routines('Runtime routines')
+      if self._optimizer is not None:
+        self._end_block()
+      self._runtime_length = self._line_counter - start
+      self._record_size(None, None, 'runtime routines', written)
+
+  @_command
+  def _write_runtime_routines(self):
+    # Call: D = return address, R13 = function address, R14 = number of arguments
+    self._write_instruction('(%s)' % self._RUNTIME_ROUTINES['call'])
+    self._write_call_sequence(['@R14', 'D=M'], ['@R13', 'A=M'])
+
+    self._write_instruction('(%s)' % self._RUNTIME_ROUTINES['return'])
+    self._write_return_sequence()
+
+    # Comparisons: D = return address. Replace the top two values on the stack with the result of
+    # comparing them, assuming the comparison is true and correcting this if it is not.
+    for jump_type in ('JGT', 'JLT', 'JEQ'):
+      end_label = '%s_END' % self._RUNTIME_ROUTINES[jump_type]
+      self._write_instructions([
+        '(%s)' % self._RUNTIME_ROUTINES[jump_type],
+        '@R15',
+        'M=D',
+
+        '@SP',
+        'AM=M-1',
+        'D=M',
+        'A=A-1',
+        'D=M-D',
+        'M=-1',
+        '@%s' % end_label,
+        'D;%s' % jump_type,
+        '@SP',
+        'A=M-1',
+        'M=0',
+        '(%s)' % end_label,
+
+        '@R15',
+        'A=M',
+        '0;JMP'
+      ])
+
+  '''Write a stub that jumps to the runtime routine of the given kind, having loaded setup (a list
+  of instructions) and then the address of return_label into D.'''
+  def _write_runtime_stub(self, kind, return_label, setup=[]):
+    self._stub_counts[kind] += 1
+    self._write_instructions(setup + [
+      '@%s' % return_label,
+      'D=A',
+      '@%s' % self._RUNTIME_ROUTINES[kind],
+      '0;JMP',
+      '(%s)' % return_label
+    ])
+
+  '''Return the number of instructions saved by using runtime routines rather than inline code, by
+  kind of routine, less the size of the routines themselves, and in total. With cache_top, each
+  comparison is measured against the code it would otherwise have been written as, which depends on
+  whether D held the top of the stack; the stub also leaves its result in memory rather than in D,
+  and any difference this makes to the commands that follow is not counted. With the peephole
+  optimizer, stubs and inline code are measured as written, as how much of them it removes depends
+  on the commands around them, so only the size of the routines is exact.'''
+  def rom_savings(self):
+    stub_lengths = {
+      'call':   self._count_instructions(self._write_runtime_stub, 'call', 'stub',
+                                         ['@f', 'D=A', '@R13', 'M=D', '@0', 'D=A', '@R14', 'M=D']),
+      'return': self._count_instructions(self._write_instructions,
+                                         ['@%s' % self._RUNTIME_ROUTINES['return'], '0;JMP']),
+    }
+    inline_lengths = {
+      'call':   self._count_instructions(self._write_call_inline, 'f', 0),
+      'return': self._count_instructions(self._write_return_sequence),
+    }
+    for jump_type in ('JGT', 'JLT', 'JEQ'):
+      stub_lengths[jump_type] = self._count_instructions(self._write_runtime_stub, jump_type,
+                                                         'stub')
+      inline_lengths[jump_type] = self._count_instructions(
+        self._write_arithmetic_binary_logical_inline, jump_type)
+
+    savings = dict([(kind, count * (inline_lengths[kind] - stub_lengths[kind]))
+                    for kind, count in self._stub_counts.items()])
+    if self._cache_top:
+      def saved(jump_type, top_in_d):
+        def write(stub):
+          self._top_in_d = top_in_d
+          self._write_comparison_cached(jump_type, stub)
+        return self._count_instructions(write, False) - self._count_instructions(write, True)
+      for jump_type, from_d in self._comparisons_from_d.items():
+        from_memory = self._stub_counts[jump_type] - from_d
+        savings[jump_type] = from_d * saved(jump_type, True) + from_memory * saved(jump_type, False)
+    savings['routines'] = -self._runtime_length
+    savings['total'] = sum(savings.values())
+    return savings
+
+  '''Return the number of instructions that calling f with args would write, without writing
+  them.'''
+  def _count_instructions(self, f, *args):
+    lines = []
+    state = (self._unique_id, dict(self._stub_counts), dict(self._comparisons_from_d),
+             self._current_function, getattr(self, '_vm_basename', None), self._top_in_d)
+    self._write = lines.append
+    try:
+      f(*args)
+    finally:
+      del self._write
+      (self._unique_id, self._stub_counts, self._comparisons_from_d, self._current_function,
+       self._vm_basename, self._top_in_d) = state
+    return len([line for line in lines
+                if line and not line.startswith('(') and not line.startswith('//')])
+
+  '''Return the number of instructions that the given commands of a VM file would be written as,
+  without writing them.'''
+  def count_instructions(self, vm_file_path, commands):
+    def write():
+      self.set_vm_filename(vm_file_path)
+      for command in commands:
+        self.write_command(command)
+    return self._count_instructions(write)
+
+  def write_command(self, command):
+    written = self._instructions_written
+    command_writer = getattr(self, 'write_%s' % command.type)
+    command_writer(command.text, *command.args)
+    self._record_size(self._vm_basename, self._current_function, self._command_kind(command),
+                      written)
+
+  '''Return the kind of command under which the size of its code is reported: the segment for push
+  and pop, the operation for arithmetic, and otherwise the command name.'''
+  def _command_kind(self, command):
+    if command.type in ('push', 'pop'):
+      return '%s %s' % (command.type, command.args[0])
+    elif command.type == 'arithmetic':
+      return command.args[0]
+    elif command.type == 'if':
+      return 'if-goto'
+    return command.type
+
+  '''Add the instructions written since the count was written to the size of the code for the given
+  file, function and kind of command.'''
+  def _record_size(self, vm_file, function, kind, written):
+    if self._instructions_written > written:
+      key = (vm_file, function, kind)
+      self.code_sizes[key] = self.code_sizes.get(key, 0) + self._instructions_written - written
 
   @_command
   def write_arithmetic(self, command):
+    if self._cache_top:
+      self._write_arithmetic_cached(command)
+      return
     for category in ArithmeticAndLogicalOpsTable.categories():
       if command in ArithmeticAndLogicalOpsTable.ops_with_symbols(category):
         method = getattr(self, '_write_arithmetic_%s' % category)
@@ -257,21 +939,142 @@ class CodeWriter:
 
   @_command
   def write_push(self, segment, index):
-    self._write_push_pop('push', segment, index)
+    if self._cache_top:
+      self._push_cached(segment, index)
+    else:
+      self._write_push_pop('push', segment, index)
 
   @_command
   def write_pop(self, segment, index):
-    self._write_push_pop('pop', segment, index)
+    if self._cache_top:
+      self._pop_cached(segment, index)
+    else:
+      self._write_push_pop('pop', segment, index)
+
+  '''Write D, if it holds the top of the stack, to memory.'''
+  def _spill(self):
+    if self._top_in_d:
+      self._push_from('D')
+      self._top_in_d = False
+
+  '''Load the top of the stack into D, unless it is already there.'''
+  def _fill(self):
+    if not self._top_in_d:
+      self._pop_into('D')
+      self._top_in_d = True
+
+  def _push_cached(self, segment, index):
+    if segment == 'constant':
+      instructions = ['@%s' % index, 'D=A']
+    elif segment in self._SEGMENT_BASES['dynamic']:
+      base = self._SEGMENT_BASES['dynamic'][segment]
+      instructions = ['@%s' % index, 'D=A', '@%s' % base, 'A=M+D', 'D=M']
+    elif segment in self._FIXED_SEGMENT_ADDRESSES:
+      instructions = ['@%d' % (self._FIXED_SEGMENT_ADDRESSES[segment] + int(index)), 'D=M']
+    elif segment == 'static':
+      instructions = ['@%s.%s' % (self._vm_basename, index), 'D=M']
+    else:
+      raise CodeWriteError('Unknown push/pop command: push %s %s' % (segment, index))
+    self._spill()
+    self._write_instructions(instructions)
+    self._top_in_d = True
+
+  def _pop_cached(self, segment, index):
+    if segment in self._SEGMENT_BASES['dynamic']:
+      base = self._SEGMENT_BASES['dynamic'][segment]
+      if int(index) <= self._MAX_ADDRESS_STEPS:
+        instructions = ['@%s' % base, 'A=M'] + ['A=A+1'] * int(index) + ['M=D']
+      else:
+        instructions = [
+          '@R13',           # R13 = value
+          'M=D',
+          '@%s' % index,    # R14 = base + index
+          'D=A',
+          '@%s' % base,
+          'D=M+D',
+          '@R14',
+          'M=D',
+          '@R13',           # *R14 = R13
+          'D=M',
+          '@R14',
+          'A=M',
+          'M=D'
+        ]
+    elif segment in self._FIXED_SEGMENT_ADDRESSES:
+      instructions = ['@%d' % (self._FIXED_SEGMENT_ADDRESSES[segment] + int(index)), 'M=D']
+    elif segment == 'static':
+      instructions = ['@%s.%s' % (self._vm_basename, index), 'M=D']
+    else:
+      raise CodeWriteError('Unknown push/pop command: pop %s %s' % (segment, index))
+    self._fill()
+    self._write_instructions(instructions)
+    self._top_in_d = False
+
+  # Binary operations on the second value on the stack (in M) and the top of the stack (in D).
+  _CACHED_BINARY_OPS = {
+    '+': 'D=D+M',
+    '-': 'D=M-D',
+    '&': 'D=D&M',
+    '|': 'D=D|M',
+  }
+
+  def _write_arithmetic_cached(self, command):
+    if command in ArithmeticAndLogicalOpsTable.ops_with_symbols('binary_transformation'):
+      self._fill()
+      self._write_instructions([
+        '@SP',
+        'AM=M-1',
+        self._CACHED_BINARY_OPS[ArithmeticAndLogicalOpsTable.symbol('binary_transformation',
+                                                                    command)]
+      ])
+    elif command in ArithmeticAndLogicalOpsTable.ops_with_symbols('unary_transformation'):
+      op = ArithmeticAndLogicalOpsTable.symbol('unary_transformation', command)
+      if self._top_in_d:
+        self._write_instruction('D=%sD' % op)
+      else:
+        self._write_arithmetic_unary_transformation(op)
+    elif command in ArithmeticAndLogicalOpsTable.ops_with_symbols('binary_logical'):
+      jump_type = ArithmeticAndLogicalOpsTable.symbol('binary_logical', command)
+      if self._optimize_size:
+        self._comparisons_from_d[jump_type] += self._top_in_d
+      self._write_comparison_cached(jump_type, self._optimize_size)
+    else:
+      raise CodeWriteError('Unknown arithmetic or logical command: %s' % command)
+
+  '''Write a comparison of the top two values on the stack, leaving the result in D, or if stub is
+  true, as a stub jumping to the runtime routine, leaving the result in memory.'''
+  def _write_comparison_cached(self, jump_type, stub):
+    if stub:
+      self._spill()
+      self._write_arithmetic_binary_logical(jump_type)
+    else:
+      jump_label = 'LOGICAL_JUMP_%s' % self._generate_unique_id()
+      self._fill()
+      self._write_instructions([
+        '@SP',
+        'AM=M-1',
+        'D=M-D',
+        '@%s_TRUE' % jump_label,
+        'D;%s' % jump_type,
+        'D=0',
+        '@%s_END' % jump_label,
+        '0;JMP',
+        '(%s_TRUE)' % jump_label,
+        'D=-1',
+        '(%s_END)' % jump_label
+      ])
 
   def _calculate_label(self, label):
     return '%s$%s' % (self._current_function, label)
 
   @_command
   def write_label(self, label):
+    self._spill()
     self._write_instruction('(%s)' % self._calculate_label(label))
 
   @_command
   def write_goto(self, label):
+    self._spill()
     self._write_instructions([
       '@%s' % self._calculate_label(label),
       '0;JMP'
@@ -279,7 +1082,10 @@ class CodeWriter:
 
   @_command
   def write_if(self, label):
-    self._pop_into('D')
+    if self._top_in_d:
+      self._top_in_d = False
+    else:
+      self._pop_into('D')
     self._write_instructions([
       '@%s' % self._calculate_label(label),
       'D;JNE'
@@ -287,6 +1093,23 @@ class CodeWriter:
 
   @_command
   def write_call(self, function_name, num_args):
+    self._spill()
+    if self._optimize_size:
+      return_address = 'return_from_%s_%s' % (function_name, self._generate_unique_id())
+      self._write_runtime_stub('call', return_address, [
+        '@%s' % function_name,
+        'D=A',
+        '@R13',
+        'M=D',
+        '@%s' % num_args,
+        'D=A',
+        '@R14',
+        'M=D'
+      ])
+    else:
+      self._write_call_inline(function_name, num_args)
+
+  def _write_call_inline(self, function_name, num_args):
     return_address = 'return_from_%s_%s' % (function_name, self._generate_unique_id())
 
     # push return_address
@@ -294,6 +1117,15 @@ class CodeWriter:
       '@%s' % return_address,
       'D=A',
     ])
+    self._write_call_sequence(
+      ['@%s' % num_args, 'D=A'],
+      ['@%s' % function_name]
+    )
+    self._write_instruction('(%s)' % return_address)
+
+  '''Write the body of a call, with the return address in D. load_num_args and load_function are
+  the instructions loading the number of arguments into D and the address of the function into A.'''
+  def _write_call_sequence(self, load_num_args, load_function):
     self._push_from('D')
 
     # push LCL, ARG, THIS, THAT
@@ -305,10 +1137,8 @@ class CodeWriter:
       self._push_from('D')
 
     # ARG = SP - (num_args + 5)
-    self._write_instructions([
-      '@%s' % num_args, # D = num_args + 5
-      'D=A',
-      '@5',
+    self._write_instructions(load_num_args + [
+      '@5',             # D = num_args + 5
       'D=A+D',
 
       '@SP',            # ARG = SP - D
@@ -326,18 +1156,17 @@ class CodeWriter:
     ])
 
     # goto function_name
-    self._write_instructions([
-      '@%s' % function_name,
+    self._write_instructions(load_function + [
       '0;JMP'
     ])
 
-    self._write_instruction('(%s)' % return_address)
-
   @_command
   def write_function(self, function_name, num_locals):
+    self._spill()
     self._current_function = function_name
 
-    locals_start, locals_end = '%s_fill_locals_start' % function_name, '%s_fill_locals_end' % function_name
+    locals_start = '%s_fill_locals_start' % function_name
+    locals_end = '%s_fill_locals_end' % function_name
     # Declare label and then push zero to stack num_locals times.
     self._write_instructions([
       '(%s)' % function_name, 
@@ -354,7 +1183,7 @@ class CodeWriter:
       '@%s' % locals_end,
       'D;JLT'
     ])
-    self._push_constant(17)
+    self._push_constant(0)
     self._write_instructions([
       '@%s' % locals_start,
       '0;JMP',
@@ -363,10 +1192,21 @@ class CodeWriter:
 
   @_command
   def write_return(self):
+    self._spill()
+    if self._optimize_size:
+      self._stub_counts['return'] += 1
+      self._write_instructions([
+        '@%s' % self._RUNTIME_ROUTINES['return'],
+        '0;JMP'
+      ])
+    else:
+      self._write_return_sequence()
+
+  def _write_return_sequence(self):
     # R14 = RET                # Store return address in temporary variable
-    # *ARG = pop()             # Put return value of function at beginning of frame of called function
-    # SP = ARG + 1             # Reposition SP so it points to just after return value of called function
-    # FRAME = LCL              # Create temporary value pointing to beginning of called function's frame
+    # *ARG = pop()             # Put return value at beginning of frame of called function
+    # SP = ARG + 1             # Reposition SP to just after return value of called function
+    # FRAME = LCL              # Temporary value pointing to beginning of called function's frame
     # THAT = *(FRAME - 1)      # Restore THAT of calling function
     # THIS = *(FRAME - 2)      # Restore THIS of calling function
     # ARG  = *(FRAME - 3)      # Restore ARG of calling function
@@ -375,11 +1215,12 @@ class CodeWriter:
 
     # Store return address in temporary variable.
     # Note that this is necessary -- I tried to be clever and retrieve the return address from
-    # *(FRAME - 5) only when I needed it for the GOTO, but if zero arguments were passed to the function from
-    # which we are returning, then ARG will point to the same memory location where the return address
-    # is stored. In such a case, when we put the return value of the function into the memory
-    # location pointed to by ARG, we overwrite the return address. (I should have figured this out
-    # from the diagram on p. 162 of the book. Because I didn't, I spent six hours debugging. Bah.)
+    # *(FRAME - 5) only when I needed it for the GOTO, but if zero arguments were passed to the
+    # function from which we are returning, then ARG will point to the same memory location where
+    # the return address is stored. In such a case, when we put the return value of the function
+    # into the memory location pointed to by ARG, we overwrite the return address. (I should have
+    # figured this out from the diagram on p. 162 of the book. Because I didn't, I spent six hours
+    # debugging. Bah.)
     self._write_instructions([
       '@5', # R14 = *(LCL - 5)
       'D=A',
@@ -475,10 +1316,18 @@ class CodeWriter:
 
   def _generate_unique_id(self):
     self._unique_id += 1
+    if self._namespace:
+      return '%s.%d' % (self._namespace, self._unique_id)
     return self._unique_id
 
   def _write_arithmetic_binary_logical(self, jump_type):
-    jump_label = 'LOGICAL_JUMP_%d' % self._generate_unique_id()
+    if self._optimize_size:
+      self._write_runtime_stub(jump_type, 'LOGICAL_JUMP_%s' % self._generate_unique_id())
+    else:
+      self._write_arithmetic_binary_logical_inline(jump_type)
+
+  def _write_arithmetic_binary_logical_inline(self, jump_type):
+    jump_label = 'LOGICAL_JUMP_%s' % self._generate_unique_id()
 
     self._pop_into('D')
     self._pop_into('A')
@@ -566,7 +1415,41 @@ class CodeWriter:
     ])
 
   def _write(self, s):
-    self._output.write(s + '\n')
+    if s and s[0] not in '(/':
+      self._instructions_written += 1
+    if self._optimizer is None:
+      self._emit(s)
+      return
+
+    # A label starts a new basic block.
+    if s.startswith('('):
+      self._end_block()
+    self._block.append(s)
+
+  def _end_block(self):
+    for line in self._optimizer.optimize(self._block):
+      self._emit(line)
+    self._block = []
+
+  def _emit(self, line):
+    is_instruction = line and not line.startswith('(') and not line.startswith('//')
+
+    # In debug mode, insert line number if line is an instruction to allow for easy correlation with
+    # commands displayed in CPU Emulator. Also, indent instruction.
+    if is_instruction:
+      if self._debug:
+        spaces = ' '*(60 - len(line))
+        line = '  %s %s// Line %d' % (line, spaces, self._line_counter)
+      self._line_counter += 1
+
+    self._buffer.append(line)
+    if len(self._buffer) >= self._BUFFER_LINES:
+      self._flush()
+
+  def _flush(self):
+    if self._buffer:
+      self._output.write('\n'.join(self._buffer) + '\n')
+      self._buffer = []
 
   def _write_newline(self):
     self._write('')
@@ -579,22 +1462,330 @@ class CodeWriter:
 
   def _write_instructions(self, commands):
     for cmd in commands:
-      is_label = cmd.startswith('(')
-
-      # Insert line number if command is not label to allow for easy correlation with commands
-      # displayed in CPU Emulator.
-      # Also, indent command unless it is a lbel.
-      if not is_label:
-        spaces = ' '*(60 - len(cmd))
-        cmd = '  %s %s// Line %d' % (cmd, spaces, self._line_counter)
-        self._line_counter += 1
       self._write(cmd)
 
+  '''Write the lines of a FragmentWriter, which has already passed them through its own optimizer,
+  given the number of stubs it wrote for each kind of runtime routine, and of comparison stubs
+  written while D held the top of the stack.'''
+  def write_fragment(self, lines, stub_counts, comparisons_from_d, code_sizes):
+    if self._optimizer is not None:
+      self._end_block()
+    for line in lines:
+      self._emit(line)
+    for kind, count in stub_counts.items():
+      self._stub_counts[kind] += count
+    for jump_type, count in comparisons_from_d.items():
+      self._comparisons_from_d[jump_type] += count
+    for key, size in code_sizes.items():
+      self.code_sizes[key] = self.code_sizes.get(key, 0) + size
+
   def close(self):
+     self._spill()
+     if self._optimizer is not None:
+       self._end_block()
+     self._flush()
      self._output.close()
 
 
+'''Writes the code for a single VM file to a list of lines, for a CodeWriter to write with
+write_fragment. Labels generated for the file are prefixed with its name, so the code for each file
+can be written independently of (and concurrently with) that for the others.'''
+class FragmentWriter(CodeWriter):
+  def __init__(self, vm_file_path, debug=False, optimizer=None, optimize_size=False,
+               cache_top=False):
+    self._init_state(debug, optimizer, optimize_size, cache_top)
+    self.set_vm_filename(vm_file_path)
+    self._namespace = self._vm_basename
+    self.lines = []
+
+  def stub_counts(self):
+    return self._stub_counts
+
+  def comparisons_from_d(self):
+    return self._comparisons_from_d
+
+  # Lines are kept as written, as instructions can only be numbered once the code for the files
+  # before this one is known.
+  def _emit(self, line):
+    self.lines.append(line)
+
+  def close(self):
+    self._spill()
+    if self._optimizer is not None:
+      self._end_block()
+
+
+'''Rewrites the assembly generated by CodeWriter a basic block at a time to eliminate stack traffic
+between adjacent VM commands: a value pushed and immediately popped is kept in a register instead,
+binary operations are performed in place on the top of the stack rather than popping both operands
+and pushing the result, and reloads of an address already in the A register are dropped.
+
+This relies on a property of CodeWriter's code: no command uses the value of the A or D register
+left by the previous command, and neither register is live at a label. (The runtime routines
+written when optimizing for size take D as an argument, but each stub loads it immediately before
+jumping.) Comment and blank lines are kept, moving past any instructions rewritten.'''
+class PeepholeOptimizer:
+  _PUSH_D = ['@SP', 'M=M+1', 'A=M-1', 'M=D']
+  _POP_D = ['@SP', 'AM=M-1', 'D=M']
+  _POP_A = ['@SP', 'AM=M-1', 'A=M']
+
+  # Binary operations computing D = A op D, where A holds the first operand popped from the stack,
+  # mapped to the same operation performed in place on the top of the stack...
+  _IN_PLACE_OPS = {
+    'D=A+D': 'M=D+M',
+    'D=A-D': 'M=M-D',
+    'D=A&D': 'M=D&M',
+    'D=A|D': 'M=D|M',
+  }
+  # ... and to the same operation reading the operand directly from memory.
+  _MEMORY_OPS = {
+    'D=A+D': 'D=D+M',
+    'D=A-D': 'D=M-D',
+    'D=A&D': 'D=D&M',
+    'D=A|D': 'D=D|M',
+  }
+  # Unary operations on the top of the stack, mapped to the same operation on D.
+  _UNARY_OPS = {
+    'M=-M': 'M=-D',
+    'M=!M': 'M=!D',
+  }
+
+  def __init__(self):
+    self.instructions_before = 0
+    self.instructions_after = 0
+
+  def optimize(self, lines):
+    # Attach comment and blank lines to the instruction following them, so that rules need only
+    # consider instructions.
+    code, attached, pending = [], [], []
+    for line in lines:
+      if not line or line.startswith('//'):
+        pending.append(line)
+      else:
+        code.append(line)
+        attached.append(pending)
+        pending = []
+    self.instructions_before += self._count_instructions(code)
+
+    i = 0
+    while i < len(code):
+      replacement = self._match(code, i)
+      if replacement is None:
+        i += 1
+        continue
+      end, instructions = replacement
+      # Comments attached to removed instructions move to whatever follows them.
+      comments = sum(attached[i:end], [])
+      if instructions:
+        new_attached = [comments] + [[] for _ in instructions[1:]]
+      elif end < len(code):
+        attached[end] = comments + attached[end]
+        new_attached = []
+      else:
+        pending = comments + pending
+        new_attached = []
+      code[i:end] = instructions
+      attached[i:end] = new_attached
+      # A rewrite may enable another ending just before it.
+      i = max(0, i - len(self._PUSH_D) - len(self._POP_D))
+
+    code, attached, trailing = self._remove_redundant_loads(code, attached)
+    pending = trailing + pending
+    self.instructions_after += self._count_instructions(code)
+
+    optimized = []
+    for instruction, comments in zip(code, attached):
+      optimized.extend(comments)
+      optimized.append(instruction)
+    return optimized + pending
+
+  # Labels are kept with the instructions, but are not instructions themselves.
+  def _count_instructions(self, code):
+    return len([line for line in code if not line.startswith('(')])
+
+  '''If a rule matches the code at index i, return the index just past the instructions it matches
+  and the instructions to replace them with. Otherwise, return None.'''
+  def _match(self, code, i):
+    window = code[i:i + 8]
+    push_d = window[:4] == self._PUSH_D
+
+    # push D; pop D => (nothing)
+    if push_d and window[4:7] == self._POP_D and not self._is_live(code, i + 7, 'A'):
+      return i + 7, []
+    # push D; pop A => A=D
+    if push_d and window[4:7] == self._POP_A:
+      return i + 7, ['A=D']
+    # push D; unary op on top of stack => push (op D)
+    if (push_d and window[4:6] == ['@SP', 'A=M-1'] and len(window) > 6 and
+        window[6] in self._UNARY_OPS):
+      return i + 7, ['@SP', 'M=M+1', 'A=M-1', self._UNARY_OPS[window[6]]]
+    # pop A; D=A op D; push D => top of stack = top of stack op D
+    if window[:3] == self._POP_A and len(window) > 3 and window[3] in self._IN_PLACE_OPS \
+        and window[4:8] == self._PUSH_D and not self._is_live(code, i + 8, 'D'):
+      return i + 8, ['@SP', 'A=M-1', self._IN_PLACE_OPS[window[3]]]
+    # A=M; D=A op D => D=M op D
+    if window[:1] == ['A=M'] and len(window) > 1 and window[1] in self._MEMORY_OPS \
+        and not self._is_live(code, i + 2, 'A'):
+      return i + 2, [self._MEMORY_OPS[window[1]]]
+    return None
+
+  '''Return whether the value of register ('A' or 'D') at index i of code may be used.'''
+  def _is_live(self, code, i, register):
+    for instruction in code[i:]:
+      if instruction.startswith('('):
+        return False
+      if instruction.startswith('@'):
+        if register == 'A':
+          return False
+        continue
+
+      dest, _, comp = instruction.rpartition('=')
+      comp, jump, _ = comp.partition(';')
+      if register in comp or (register == 'A' and ('M' in comp or 'M' in dest or jump)):
+        return True
+      if register in dest:
+        return False
+    # The end of a block is always at a label or between commands.
+    return False
+
+  def _remove_redundant_loads(self, code, attached):
+    kept_code, kept_attached, carried = [], [], []
+    address = None
+    for instruction, comments in zip(code, attached):
+      if instruction.startswith('@'):
+        if instruction == address:
+          carried.extend(comments)
+          continue
+        address = instruction
+      elif instruction.startswith('(') or 'A' in instruction.rpartition('=')[0]:
+        address = None
+      kept_code.append(instruction)
+      kept_attached.append(carried + comments)
+      carried = []
+    return kept_code, kept_attached, carried
+
+
+'''Summarizes where the instructions of a translated program go, given the code_sizes of a
+Translator: the number of instructions written for each VM function, each VM file and each kind of
+command (push and pop by segment, each arithmetic and comparison operation, call, return and so
+on), largest first. Sizes are counted before any peephole optimization.'''
+class CodeSizeReport:
+  _OTHER = '(bootstrap)'
+
+  def __init__(self, code_sizes):
+    self._code_sizes = code_sizes
+
+  def summary(self):
+    functions, files, commands = {}, {}, {}
+    for (vm_file, function, kind), size in self._code_sizes.items():
+      for totals, key in ((functions, function), (files, vm_file), (commands, kind)):
+        key = key or self._OTHER
+        totals[key] = totals.get(key, 0) + size
+    return {
+      'total': sum(self._code_sizes.values()),
+      'functions': functions,
+      'files': files,
+      'commands': commands,
+    }
+
+  def write_json(self, output):
+    json.dump(self.summary(), output, indent=2, sort_keys=True)
+    output.write('\n')
+
+  def write_table(self, output):
+    summary = self.summary()
+    total = summary['total']
+    output.write('%d instructions\n' % total)
+    for heading, section in (('Function', 'functions'), ('File', 'files'), ('Command', 'commands')):
+      output.write('\n%-40s %12s %7s\n' % (heading, 'instructions', 'share'))
+      for key, size in sorted(summary[section].items(), key=lambda (key, size): (-size, key)):
+        output.write('%-40s %12d %6.1f%%\n' % (key, size, 100.0 * size / max(total, 1)))
+
+
+'''Add the options of the translator to arg_parser, for translate_from_arguments.'''
+def add_arguments(arg_parser):
+  arg_parser.add_argument('--debug', action='store_true',
+                          help='annotate output with VM commands and instruction line numbers')
+  arg_parser.add_argument('-O', '--optimize', action='store_true',
+                          help='eliminate stack traffic between VM commands with a peephole '
+                               'optimizer')
+  arg_parser.add_argument('-Os', '--optimize-size', action='store_true',
+                          help='share one runtime routine for each of call, return and the '
+                               'comparisons, rather than writing them inline')
+  arg_parser.add_argument('--cache-top', action='store_true',
+                          help='keep the top of the stack in the D register between VM commands '
+                               '(cannot be combined with -O)')
+  arg_parser.add_argument('-j', '--jobs', type=int, default=None,
+                          help='translate each VM file separately, with labels named after the '
+                               'file, in this many worker processes (0: one per CPU), writing the '
+                               'files in order of name')
+  arg_parser.add_argument('--cache-dir',
+                          help='directory in which to cache the code for each VM file, translating '
+                               'only the files that have changed (labels are named after the file, '
+                               'as with -j)')
+  arg_parser.add_argument('--cache-size', type=int, default=64,
+                          help='size in megabytes beyond which the least recently used cache '
+                               'entries are evicted (default: 64)')
+  arg_parser.add_argument('--eliminate-dead-functions', action='store_true',
+                          help='omit functions that cannot be reached from Sys.init')
+  arg_parser.add_argument('--inline', type=int, metavar='MAX_SIZE',
+                          help='inline calls to functions of at most MAX_SIZE VM commands')
+  arg_parser.add_argument('--inline-growth', type=float, default=10.0, metavar='PERCENT',
+                          help='stop inlining once the program has grown by PERCENT%% of its VM '
+                               'commands (default: 10)')
+  arg_parser.add_argument('--size-report', choices=('table', 'json'),
+                          help='write the number of instructions written for each function, file '
+                               'and kind of command to standard output, as a table or as JSON')
+
+'''Translate args.path with the options added by add_arguments, reporting the effect of any
+optimizations on standard error, and return the Translator.'''
+def translate_from_arguments(args, arg_parser, code_writer_factory=None):
+  if args.cache_top and args.optimize:
+    arg_parser.error('--cache-top cannot be combined with -O')
+  if args.cache_dir:
+    cache = FragmentCache(args.cache_dir, args.cache_size * 1024 * 1024)
+  else:
+    cache = None
+
+  translator = Translator(args.path, debug=args.debug, optimize=args.optimize,
+                          optimize_size=args.optimize_size,
+                          eliminate_dead_functions=args.eliminate_dead_functions,
+                          inline_max_size=args.inline, inline_max_growth=args.inline_growth / 100,
+                          cache_top=args.cache_top, jobs=args.jobs, cache=cache,
+                          code_writer_factory=code_writer_factory)
+  if cache:
+    sys.stderr.write('Fragment cache: %d of %d files reused\n' % (translator.fragments_reused,
+                                                                  len(translator.program.files)))
+  if translator.inliner:
+    inlined = translator.inliner.inlined
+    sys.stderr.write('Inlining: %d calls to %d functions inlined\n' % (sum(inlined.values()),
+                                                                      len(inlined)))
+  if translator.dead_functions is not None:
+    for name, instructions in translator.dead_functions:
+      sys.stderr.write('Removed unreachable function %s (%d instructions)\n' % (name, instructions))
+    saved = sum([instructions for _, instructions in translator.dead_functions])
+    sys.stderr.write('Dead function elimination: %d functions removed, %d instructions saved\n' % (
+      len(translator.dead_functions), saved))
+  if translator.optimizer:
+    optimizer = translator.optimizer
+    before, after = optimizer.instructions_before, optimizer.instructions_after
+    sys.stderr.write('Peephole optimization: %d -> %d instructions (%d removed, %.1f%%)\n' % (
+      before, after, before - after, 100.0 * (before - after) / max(before, 1)))
+  if translator.rom_savings:
+    savings = translator.rom_savings
+    sys.stderr.write('Size optimization: %d instructions saved (calls %d, returns %d, '
+                     'comparisons %d, runtime routines %d)\n' % (
+      savings['total'], savings['call'], savings['return'],
+      savings['JGT'] + savings['JLT'] + savings['JEQ'], savings['routines']))
+  if args.size_report == 'json':
+    CodeSizeReport(translator.code_sizes).write_json(sys.stdout)
+  elif args.size_report == 'table':
+    CodeSizeReport(translator.code_sizes).write_table(sys.stdout)
+  return translator
+
+
 if __name__ == '__main__':
-  if len(sys.argv) != 2:
-    sys.exit('Usage: %s [VM file, or directory containing VM files]' % sys.argv[0])
-  Translator(sys.argv[1])
+  arg_parser = argparse.ArgumentParser(description='Translate VM code into Hack assembly.')
+  arg_parser.add_argument('path', help='VM file, or directory containing VM files')
+  add_arguments(arg_parser)
+  translate_from_arguments(arg_parser.parse_args(), arg_parser)